@@ -24,30 +24,60 @@
 
 
 # general parameters
-parameters = {# "pairs_only" or "tuples_intersection"
+parameters = {# "pairs_only", "tuples_intersection", "tuples_exact" or
+              # "tuples_correlation"
               "selection_mode": "tuples_intersection",
               # "authority" or "reciprocal"
               "effectiveness_estimation_measure": "reciprocal",
-              # "jaccard", "jaccard_k", "rbo", "kendalltau", "spearman",
-              # "kendallw", "kappa", "fleiss", "alpha", "scotts"
+              # "jaccard", "jaccard_k", "rbo", "rbo_ext", "kendalltau",
+              # "spearman", "kendallw", "kappa", "fleiss", "alpha", "scotts"
               "correlation_measure": "rbo",
+              # measure of "tuples_correlation": "generalized_jaccard",
+              # "kendallw", "kappa", "fleiss", "alpha" or "scotts"
+              "tuple_correlation_measure": "generalized_jaccard",
+              # persistence parameter of "rbo" and "rbo_ext"
+              "rbo_p": 0.9,
               # top_k = 0 to use the dataset default
               "top_k": 0,
+              # values of top_k to evaluate in a single pass before the
+              # other stages, e.g. list(range(5, 55, 5)); [] to disable
+              "top_k_sweep": [],
               "beta": -1,
+              # the estimation keeps the sign (regime) of the beta above
               "estimate_expoents": False,
+              # values of beta evaluated by the estimation (start, stop, num)
+              "beta_grid": (-10, 10, 401),
               # "map" or "precision"
               "supervised_effectiveness": "map",
-              # number of top tuples to run with UDLF in fusion stage
+              # number of top tuples to fuse with CPRR in fusion stage
               "top_tuples_fusion": 5,
+              # CPRR fusion and supervised evaluation through the "udlf"
+              # binary or the "native" (in-process NumPy) implementation
+              "fusion_backend": "udlf",
               # number of top tuples to compute the "tuples_intersection"
+              # and "tuples_correlation"
               "top_tuples_intersection": 100,
+              # number of top tuples of each size found by "tuples_exact"
+              "top_tuples_exact": 100,
               # maximum size for the selected tuples
               "max_tuple_size": 6,
               "perform_fusion": True,
+              # only compute the correlations of the pairs that can reach
+              # the top tuples (for "pairs_only" or "tuples_intersection")
+              "lazy_correlations": False,
+              # export the effectiveness and correlation of each query
+              "save_query_scores": False,
               # evaluation stage executes and evaluates all pairs
               "perform_evaluation": False,
+              # values of k of the P@k and Recall@k shown by the evaluation
+              # (top_k is always included)
+              "evaluation_precisions": [5, 10, 20, 50],
               # 0 to use the number of CPUs; 1 for serial execution
-              "multithreading_pools": 0}
+              "multithreading_pools": 0,
+              # directory to store the binary ranked lists and other caches
+              "cache_dir": "cache/",
+              # maximum size of the cached results (LRU); 0 to disable
+              "cache_max_size_mb": 1024}
 
 # mpeg7
 dataset_mpeg7 = {"name": "mpeg7",
@@ -21,13 +21,20 @@
 #
 
 
-import math
+import itertools
 import numpy as np
-from nltk import agreement
-from multiprocessing import Pool
+import load_data
+from functools import partial
 
+popcount_table = np.array([bin(i).count('1') for i in range(256)],
+                          dtype=np.uint8)
 
-def get_correlation_func(correlation_measure):
+
+def get_correlation_func(correlation_measure, rbo_p=0.9):
+    """
+    Returns a function that computes the correlation measure for all
+    the queries of a pair, given their N x k ranked lists matrices
+    """
     if correlation_measure == "jaccard":
         return compute_jaccard
 
@@ -35,7 +42,10 @@ def get_correlation_func(correlation_measure):
         return compute_jaccard_k
 
     if correlation_measure == "rbo":
-        return compute_rbo
+        return partial(compute_rbo, p=rbo_p)
+
+    if correlation_measure == "rbo_ext":
+        return partial(compute_rbo_ext, p=rbo_p)
 
     if correlation_measure == "kendalltau":
         return compute_kendalltau
@@ -66,6 +76,17 @@ def get_correlation_func(correlation_measure):
     exit(1)
 
 
+def get_correlation_range(correlation_measure):
+    """
+    Returns the (minimum, maximum) values of the correlation measure
+    """
+    if correlation_measure in ["kappa", "fleiss", "scotts"]:
+        return -1, 1
+    if correlation_measure == "alpha":
+        return -np.inf, 1
+    return 0, 1
+
+
 def get_correlation_func_tuples(correlation_measure):
     if correlation_measure == "kendallw":
         return kendall_w
@@ -83,51 +104,162 @@ def get_correlation_func_tuples(correlation_measure):
         return scotts
 
     if correlation_measure == "generalized_jaccard":
-        return generalized_jaccard
+        return partial(compute_per_query_tuple, generalized_jaccard)
 
     print("\n ERROR: Unknown correlation measure:",
           correlation_measure)
     exit(1)
 
 
-def compute_jaccard(x, y, top_k):
-    return len(set(x) & set(y))/len(set(x) | set(y))
+def compute_bitsets(rks, size):
+    """
+    Returns the N x ceil(size/64) matrix of packed bitsets representing
+    the set of elements in the ranked list of each query
+    """
+    n = rks.shape[0]
+    rks = rks.astype(np.uint64)
+    bitsets = np.zeros((n, (size+63)//64), dtype=np.uint64)
+    rows = np.repeat(np.arange(n), rks.shape[1])
+    np.bitwise_or.at(bitsets,
+                     (rows, (rks >> np.uint64(6)).ravel()),
+                     (np.uint64(1) << (rks & np.uint64(63))).ravel())
+    return bitsets
 
 
-def compute_jaccard_k(x, y, top_k):
-    score = 0
+def popcount(bitsets):
+    """
+    Returns the number of bits set in each row of 'bitsets'
+    """
+    bitsets = np.ascontiguousarray(bitsets)
+    n = bitsets.shape[0]
+    return popcount_table[bitsets.view(np.uint8)].reshape(n, -1).sum(axis=1)
+
+
+def test_bits(bitsets, elements):
+    """
+    Verifies, for each query, if its element is in its bitset
+    """
+    elements = elements.astype(np.uint64)
+    words = bitsets[np.arange(bitsets.shape[0]),
+                    (elements >> np.uint64(6)).astype(np.int64)]
+    return ((words >> (elements & np.uint64(63))) & np.uint64(1)).astype(int)
+
+
+def set_bits(bitsets, elements):
+    """
+    Adds to the bitset of each query its element
+    """
+    elements = elements.astype(np.uint64)
+    rows = np.arange(bitsets.shape[0])
+    cols = (elements >> np.uint64(6)).astype(np.int64)
+    bitsets[rows, cols] |= np.uint64(1) << (elements & np.uint64(63))
+
+
+def count_bits_in(bitsets, rks):
+    """
+    Returns, for each query, how many elements of its ranked list (row of
+    'rks') are in its bitset
+    """
+    rks = rks.astype(np.uint64)
+    rows = np.arange(bitsets.shape[0])[:, None]
+    words = bitsets[rows, (rks >> np.uint64(6)).astype(np.int64)]
+    return np.sum((words >> (rks & np.uint64(63))) & np.uint64(1), axis=1)
 
-    for k in range(1, top_k+1):
-        inter = len(set(x[:k]) & set(y[:k]))
-        union = len(set(x[:k]) | set(y[:k]))
-        score += (inter/union)
 
-    score = score/top_k
+def get_bitsets_size(rks1, rks2):
+    return int(max(np.max(rks1), np.max(rks2))) + 1
 
-    return score
 
+def compute_jaccard(rks1, rks2, top_k):
+    rks1 = rks1[:, :top_k]
+    rks2 = rks2[:, :top_k]
+    size = get_bitsets_size(rks1, rks2)
+    bitsets1 = compute_bitsets(rks1, size)
+    bitsets2 = compute_bitsets(rks2, size)
+    inter = popcount(bitsets1 & bitsets2)
+    union = popcount(bitsets1 | bitsets2)
+    return inter/union
 
-def compute_rbo(x, y, top_k):
-    p = 0.9
-    score = 0
 
+def compute_jaccard_k(rks1, rks2, top_k):
+    """
+    The prefix bitsets are built incrementally, so the intersection at
+    depth k is obtained from the intersection at depth k-1 by testing
+    only the two new elements
+    """
+    rks1 = rks1[:, :top_k]
+    rks2 = rks2[:, :top_k]
+    n, top_k = rks1.shape
+    size = get_bitsets_size(rks1, rks2)
+    bitsets1 = np.zeros((n, (size+63)//64), dtype=np.uint64)
+    bitsets2 = np.zeros((n, (size+63)//64), dtype=np.uint64)
+    inter = np.zeros(n)
+    score = np.zeros(n)
     for k in range(1, top_k+1):
-        inter = len(set(x[:k]) & set(y[:k]))
-        score += (p**(k-1))*(inter/k)
+        x = rks1[:, k-1]
+        y = rks2[:, k-1]
+        inter += test_bits(bitsets2, x) + test_bits(bitsets1, y) + (x == y)
+        set_bits(bitsets1, x)
+        set_bits(bitsets2, y)
+        score += inter/(2*k - inter)
+    return score/top_k
 
-    score = (1-p)*score
 
-    return score
+def compute_positions_in(rks1, rks2):
+    """
+    For each query, returns the position of each element of 'rks1' in
+    the ranked list of 'rks2' (or k when it is absent).
+    The lists of all queries are matched at once by sorting them together.
+    """
+    n, k = rks1.shape
+    values = np.concatenate([rks1, rks2], axis=1).astype(np.int64)
+    order = np.argsort(values, axis=1, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=1)
+    # Since the sort is stable, the element of 'rks1' comes first
+    queries, cols = np.nonzero(sorted_values[:, 1:] == sorted_values[:, :-1])
+    positions = np.full((n, k), k, dtype=np.int64)
+    positions[queries, order[queries, cols]] = order[queries, cols+1] - k
+    return positions
+
+
+def compute_overlaps(rks1, rks2):
+    """
+    Returns a N x k matrix with the size of the intersection between the
+    top-d elements of both ranked lists of each query, for d in 1..k
+    """
+    n, k = rks1.shape
+    positions = compute_positions_in(rks1, rks2)
+    # Each common element enters the intersection at the deepest position
+    depths = np.maximum(np.arange(k), positions)
+    bins = (np.arange(n)[:, None]*(k+1) + depths).ravel()
+    counts = np.bincount(bins, minlength=n*(k+1)).reshape(n, k+1)
+    return np.cumsum(counts[:, :k], axis=1)
+
+
+def compute_rbo(rks1, rks2, top_k, p=0.9):
+    depths = np.arange(1, top_k+1)
+    overlaps = compute_overlaps(rks1[:, :top_k], rks2[:, :top_k])
+    return (1-p)*((overlaps/depths) @ (p**(depths-1)))
 
 
-def get_index(i, x):
+def compute_rbo_ext(rks1, rks2, top_k, p=0.9):
     """
-    Returns the position of the element 'i' in the ranked list 'x'
+    Extrapolated RBO, which assumes the agreement observed at depth k
+    continues indefinitely for the unseen part of the ranked lists
     """
-    if i in x:
-        return x.index(i)
-    else:
-        return len(x)
+    overlaps = compute_overlaps(rks1[:, :top_k], rks2[:, :top_k])
+    residual = (p**top_k)*overlaps[:, -1]/top_k
+    return compute_rbo(rks1, rks2, top_k, p=p) + residual
+
+
+def compute_per_query_tuple(correlation_function, rks, top_k):
+    """
+    Applies a tuple correlation function defined for a single query to
+    the ranked lists of every query
+    """
+    n = int(len(rks[0]))
+    return np.array([correlation_function([rk[i] for rk in rks], top_k)
+                     for i in range(n)])
 
 
 def check_sizes(x, y):
@@ -139,47 +271,80 @@ def check_sizes(x, y):
     return True
 
 
-def compute_kendalltau(x, y, top_k):
-    inter = []
-    for elem in (set(x) | set(y)):
-        inter.append((get_index(elem, x), get_index(elem, y)))
-
-    ktau = 0
-    n = len(inter)
-    for i in range(0, n):
-        for j in range(i+1, n):
-            comp1 = int(inter[i][0] >= inter[j][0])
-            comp2 = int(inter[i][1] >= inter[j][1])
-            if (comp1 != comp2):
-                ktau += 1
-
-    ktau = ktau/((n*(n-1))/2)
-
-    return (1-ktau)
+def count_inversions(sequences):
+    """
+    Counts, for each row, the pairs i < j with sequences[i] > sequences[j].
+    Implemented as a bottom-up merge sort applied to all the rows at once.
+    """
+    n, length = sequences.shape
+    size = 1
+    while size < length:
+        size *= 2
+    big = int(np.max(sequences)) + 1
+    runs = np.full((n, size), big, dtype=np.int64)
+    runs[:, :length] = sequences
+    inversions = np.zeros(n, dtype=np.int64)
+    width = 1
+    while width < size:
+        blocks = runs.reshape(n, -1, 2, width)
+        # Shift each block by a distinct offset, so all the left runs form
+        # a single sorted array and can be searched at once
+        offsets = (np.arange(n*blocks.shape[1])*(big+1)).reshape(n, -1, 1)
+        left = (blocks[:, :, 0, :] + offsets).ravel()
+        right = (blocks[:, :, 1, :] + offsets).ravel()
+        left_end = np.repeat(np.arange(1, left.size//width + 1)*width, width)
+        greater = left_end - np.searchsorted(left, right, side='right')
+        inversions += greater.reshape(n, -1).sum(axis=1)
+        runs = np.sort(blocks.reshape(n, -1, 2*width), axis=2).reshape(n, size)
+        width *= 2
+    return inversions
+
+
+def compute_kendalltau(rks1, rks2, top_k, penalty=0.5):
+    """
+    Kendall tau distance for top-k lists (Fagin's K^(p)), where missing
+    elements are placed at position k. Pairs of elements that only appear
+    in one of the lists are tied in the other one and receive 'penalty'.
+    """
+    rks1 = rks1[:, :top_k]
+    rks2 = rks2[:, :top_k]
+    n, top_k = rks1.shape
+    positions1 = compute_positions_in(rks1, rks2)
+    positions2 = compute_positions_in(rks2, rks1)
+    missing1 = np.sum(positions1 == top_k, axis=1)
+    missing2 = np.sum(positions2 == top_k, axis=1)
+    # Sort the union by the positions in the first list (ties by the
+    # positions in the second one) and count the inversions in the second
+    only_second = np.sort(np.where(positions2 == top_k,
+                                   np.arange(top_k),
+                                   2*top_k), axis=1)
+    sequences = np.concatenate([positions1, only_second], axis=1)
+    discordant = count_inversions(sequences)
+    tied = (missing1*(missing1-1) + missing2*(missing2-1))/2
+    union = top_k + missing2
+    n_pairs = np.maximum(union*(union-1)/2, 1)
+    return 1 - (discordant + penalty*tied)/n_pairs
 
 
 def get_pos_list(rks):
-    rks_pos = []
-    for rk in rks:
-        rk_pos = [get_index(i+1, rk)+1 for i, x in enumerate(rk)]
-        rks_pos.append(rk_pos)
-    return rks_pos
-
-
-def kendall_w(rks, top_k):
-    # compute pos list from ranked lists
-    rks = [rk[:top_k] for rk in rks]
-    rks = get_pos_list(rks)
+    """
+    Returns a m x N x k stack with the (1-based) position of the images
+    1..k in each ranked list, or k+1 for the images not in the list
+    """
+    m, n, top_k = rks.shape
+    rks_pos = np.full((m, n, top_k+1), top_k+1, dtype=np.int64)
+    lists, queries, positions = np.nonzero(rks <= top_k)
+    rks_pos[lists, queries, rks[lists, queries, positions]] = positions+1
+    return rks_pos[:, :, 1:]
 
-    m = len(rks)  # number of ranked lists to compare
-    n = len(rks[0])  # number of elements in each ranked list
 
-    # compute kendall w
-    r = np.sum(rks, axis=0)
-    a = np.sum(r)/n
-    d = [math.fabs(x-a) for x in r]
-    d2 = [x**2 for x in d]
-    s = np.sum(d2)
+def compute_kendall_w_from_ranks(r, m):
+    """
+    Kendall's W given the N x k sum 'r' of the positions in m lists
+    """
+    n = r.shape[1]  # number of elements in each ranked list
+    a = np.sum(r, axis=1, keepdims=True)/n
+    s = np.sum((r-a)**2, axis=1)
     w = (12*s)/(m**2*(n)*(n**2-1))
 
     # compute chi squared
@@ -190,80 +355,172 @@ def kendall_w(rks, top_k):
     return w
 
 
-def compute_kendallw(x, y, top_k):
-    rks = [x, y]
-    return kendall_w(rks, top_k)
+def kendall_w(rks, top_k):
+    """
+    Kendall's W for the m ranked lists of all queries at once
+    ('rks' is a m x N x k stack or a list of m N x k matrices)
+    """
+    # compute pos list from ranked lists
+    rks = np.stack([rk[:, :top_k] for rk in rks]).astype(np.int64)
+    rks = get_pos_list(rks)
 
+    m = rks.shape[0]  # number of ranked lists to compare
+    return compute_kendall_w_from_ranks(np.sum(rks, axis=0), m)
 
-def compute_spearman(x, y, top_k):
-    inter = []
-    for elem in (set(x) | set(y)):
-        inter.append((get_index(elem, x), get_index(elem, y)))
 
-    spearman = 0
-    n = len(inter)
-    for i in range(0, n):
-        spearman += abs(inter[i][0]-inter[i][1])
+def compute_kendallw(rks1, rks2, top_k):
+    return kendall_w([rks1, rks2], top_k)
 
-    spearman = spearman/(len(x)*(len(x)+1))
 
+def compute_spearman(rks1, rks2, top_k):
+    """
+    Spearman footrule, where missing elements are placed at position k
+    """
+    rks1 = rks1[:, :top_k]
+    rks2 = rks2[:, :top_k]
+    top_k = rks1.shape[1]
+    depths = np.arange(top_k)
+    positions1 = compute_positions_in(rks1, rks2)
+    positions2 = compute_positions_in(rks2, rks1)
+    # Elements of the first list, then the ones only in the second list
+    spearman = np.sum(np.abs(positions1 - depths), axis=1)
+    spearman += np.sum(np.where(positions2 == top_k, top_k - depths, 0),
+                       axis=1)
+    spearman = spearman/(top_k*(top_k+1))
     return (1-spearman)
 
 
+def compute_agreement_counts(rks, top_k):
+    """
+    Each ranked list is seen as a coder that assigns one image (label) to
+    each position (item). For each pair of coders, returns the number of
+    positions where both agree and the number of labels both used, for
+    all the queries. As images are unique in a ranked list, these counts
+    are enough to derive the contingency tables of the measures below.
+    """
+    rks = [rk[:, :top_k] for rk in rks]
+    top_k = rks[0].shape[1]
+    agreements = []
+    intersections = []
+    for rk1, rk2 in itertools.combinations(rks, 2):
+        agreements.append(np.sum(rk1 == rk2, axis=1))
+        intersections.append(np.sum(compute_positions_in(rk1, rk2) < top_k,
+                                    axis=1))
+    return np.array(agreements), np.array(intersections), top_k
+
+
+def chance_corrected_agreement(observed, expected):
+    """
+    Returns 1 when the expected agreement is already perfect
+    """
+    perfect = np.isclose(expected, 1)
+    return np.where(perfect, 1.0,
+                    (observed - expected)/np.where(perfect, 1, 1 - expected))
+
+
+def compute_agreement_from_sums(correlation_measure,
+                                agreements,
+                                intersections,
+                                kappas,
+                                m,
+                                top_k):
+    """
+    Agreement measures given the sums, over each pair of the m ranked
+    lists, of the counts of compute_agreement_counts and of the pair kappas
+    """
+    n_pairs = m*(m-1)/2
+    if correlation_measure == "kappa":
+        return kappas/n_pairs
+    observed = agreements/(n_pairs*top_k)
+    if correlation_measure == "fleiss":
+        expected = intersections/(n_pairs*top_k**2)
+        return chance_corrected_agreement(observed, expected)
+    total = m*top_k
+    squared_freqs = get_squared_label_frequencies(intersections, m, top_k)
+    if correlation_measure == "scotts":
+        expected = squared_freqs/(total**2)
+        return chance_corrected_agreement(observed, expected)
+    # Krippendorff's alpha
+    observed_disagreement = 1 - observed
+    expected_disagreement = (total**2 - squared_freqs)/(total*(total-1))
+    # A single label used by all the coders means perfect agreement
+    single_label = expected_disagreement == 0
+    return np.where(single_label, 1.0,
+                    1 - observed_disagreement /
+                    np.where(single_label, 1, expected_disagreement))
+
+
+def compute_pair_kappas(agreements, intersections, top_k):
+    observed = agreements/top_k
+    expected = intersections/(top_k**2)
+    return chance_corrected_agreement(observed, expected)
+
+
+def compute_agreement(correlation_measure, rks, top_k):
+    agreements, intersections, top_k = compute_agreement_counts(rks, top_k)
+    kappas = None
+    if correlation_measure == "kappa":
+        kappas = np.sum(compute_pair_kappas(agreements, intersections, top_k),
+                        axis=0)
+    return compute_agreement_from_sums(correlation_measure,
+                                       np.sum(agreements, axis=0),
+                                       np.sum(intersections, axis=0),
+                                       kappas,
+                                       len(rks),
+                                       top_k)
+
+
 def kappa(rks, top_k):
-    rks = [rk[:top_k] for rk in rks]
-    taskdata = []
-    for j, rk in enumerate(rks):
-        taskdata += [[j, str(i), str(rk[i])] for i in range(0, len(rk))]
-    ratingtask = agreement.AnnotationTask(data=taskdata)
-    return ratingtask.kappa()
+    """
+    Cohen's kappa, averaged over each pair of ranked lists
+    """
+    return compute_agreement("kappa", rks, top_k)
 
 
-def compute_kappa(x, y, top_k):
-    rks = [x, y]
-    return kappa(rks, top_k)
+def compute_kappa(rks1, rks2, top_k):
+    return kappa([rks1, rks2], top_k)
 
 
 def fleiss(rks, top_k):
-    rks = [rk[:top_k] for rk in rks]
-    taskdata = []
-    for j, rk in enumerate(rks):
-        taskdata += [[j, str(i), str(rk[i])] for i in range(0, len(rk))]
-    ratingtask = agreement.AnnotationTask(data=taskdata)
-    return ratingtask.multi_kappa()
+    """
+    Fleiss' kappa (multi-kappa of Davies and Fleiss), which averages the
+    observed and expected agreements over each pair of ranked lists
+    """
+    return compute_agreement("fleiss", rks, top_k)
 
 
-def compute_fleiss(x, y, top_k):
-    rks = [x, y]
-    return fleiss(rks, top_k)
+def compute_fleiss(rks1, rks2, top_k):
+    return fleiss([rks1, rks2], top_k)
+
+
+def get_squared_label_frequencies(intersections, m, top_k):
+    """
+    Sum of the squared number of times each label was used by all the
+    coders, given the total number of labels shared by the pairs of coders
+    """
+    return m*top_k + 2*intersections
 
 
 def alpha(rks, top_k):
-    rks = [rk[:top_k] for rk in rks]
-    taskdata = []
-    for j, rk in enumerate(rks):
-        taskdata += [[j, str(i), str(rk[i])] for i in range(0, len(rk))]
-    ratingtask = agreement.AnnotationTask(data=taskdata)
-    return ratingtask.alpha()
+    """
+    Krippendorff's alpha with the binary distance
+    """
+    return compute_agreement("alpha", rks, top_k)
 
 
-def compute_alpha(x, y, top_k):
-    rks = [x, y]
-    return alpha(rks, top_k)
+def compute_alpha(rks1, rks2, top_k):
+    return alpha([rks1, rks2], top_k)
 
 
 def scotts(rks, top_k):
-    rks = [rk[:top_k] for rk in rks]
-    taskdata = []
-    for j, rk in enumerate(rks):
-        taskdata += [[j, str(i), str(rk[i])] for i in range(0, len(rk))]
-    ratingtask = agreement.AnnotationTask(data=taskdata)
-    return ratingtask.pi()
+    """
+    Scott's pi (multi-pi for more than two ranked lists)
+    """
+    return compute_agreement("scotts", rks, top_k)
 
 
-def compute_scotts(x, y, top_k):
-    rks = [x, y]
-    return scotts(rks, top_k)
+def compute_scotts(rks1, rks2, top_k):
+    return scotts([rks1, rks2], top_k)
 
 
 def generalized_jaccard(rks, top_k):
@@ -273,46 +530,234 @@ def generalized_jaccard(rks, top_k):
     return len(intersec)/len(union)
 
 
+def init_tuple_context(correlation_measure, rks, top_k):
+    """
+    Returns the data shared by the incremental tuple correlations of the
+    ranked lists matrices in 'rks' (one for each descriptor index)
+    """
+    if correlation_measure not in ["generalized_jaccard", "kendallw",
+                                   "kappa", "fleiss", "alpha", "scotts"]:
+        print("\n ERROR: Unknown tuple correlation measure:",
+              correlation_measure)
+        exit(1)
+    rks = [rk[:, :top_k] for rk in rks]
+    return {"measure": correlation_measure,
+            "rks": rks,
+            "top_k": rks[0].shape[1],
+            "size": max([int(np.max(rk)) for rk in rks]) + 1,
+            "bitsets": {},
+            "positions": {},
+            "counts": {}}
+
+
+def get_context_bitsets(context, index):
+    if index not in context["bitsets"]:
+        context["bitsets"][index] = compute_bitsets(context["rks"][index],
+                                                    context["size"])
+    return context["bitsets"][index]
+
+
+def get_context_positions(context, index):
+    if index not in context["positions"]:
+        rks = context["rks"][index][None].astype(np.int64)
+        context["positions"][index] = get_pos_list(rks)[0]
+    return context["positions"][index]
+
+
+def get_context_counts(context, index1, index2):
+    """
+    Agreement counts and kappa of a pair, computed once for each pair
+    """
+    key = (min(index1, index2), max(index1, index2))
+    if key not in context["counts"]:
+        top_k = context["top_k"]
+        agreements, intersections, top_k = compute_agreement_counts(
+                                                [context["rks"][key[0]],
+                                                 context["rks"][key[1]]],
+                                                top_k)
+        context["counts"][key] = (agreements[0],
+                                  intersections[0],
+                                  compute_pair_kappas(agreements[0],
+                                                      intersections[0],
+                                                      top_k))
+    return context["counts"][key]
+
+
+def extend_tuple_state(context, state, index):
+    """
+    Returns the state of the tuple of 'state' extended by the descriptor
+    'index' (the given state is not modified)
+    """
+    measure = context["measure"]
+    extended = {"indexes": state["indexes"] + [index]}
+    if measure == "generalized_jaccard":
+        bitsets = get_context_bitsets(context, index)
+        if state["indexes"] == []:
+            extended["intersection"] = bitsets
+            extended["union"] = bitsets
+        else:
+            extended["intersection"] = state["intersection"] & bitsets
+            extended["union"] = state["union"] | bitsets
+        extended["union_size"] = popcount(extended["union"])
+    elif measure == "kendallw":
+        positions = get_context_positions(context, index)
+        extended["positions"] = state.get("positions", 0) + positions
+    else:
+        for key in ["agreements", "intersections", "kappas"]:
+            extended[key] = state.get(key, 0)
+        for member in state["indexes"]:
+            counts = get_context_counts(context, member, index)
+            for key, value in zip(["agreements",
+                                   "intersections",
+                                   "kappas"], counts):
+                extended[key] = extended[key] + value
+    return extended
+
+
+def compute_tuple_state(context, indexes):
+    """
+    Returns the state of the tuple 'indexes' (intersection and union
+    bitsets, summed positions or summed agreement counts, according to
+    the measure), built by adding one ranked list at a time
+    """
+    state = {"indexes": []}
+    for index in indexes:
+        state = extend_tuple_state(context, state, index)
+    return state
+
+
+def compute_extended_correlation(context, state, index):
+    """
+    Returns the correlation of each query for the tuple of the 'state'
+    extended by the descriptor 'index', without building its state
+    """
+    measure = context["measure"]
+    top_k = context["top_k"]
+    m = len(state["indexes"]) + 1
+    if measure == "generalized_jaccard":
+        rks = context["rks"][index]
+        intersection = count_bits_in(state["intersection"], rks)
+        union = state["union_size"] + top_k - count_bits_in(state["union"],
+                                                            rks)
+        return intersection/union
+    if measure == "kendallw":
+        return compute_kendall_w_from_ranks(
+                state["positions"] + get_context_positions(context, index),
+                m)
+    sums = [state[key] for key in ["agreements", "intersections", "kappas"]]
+    for member in state["indexes"]:
+        counts = get_context_counts(context, member, index)
+        sums = [value + count for value, count in zip(sums, counts)]
+    return compute_agreement_from_sums(measure, sums[0], sums[1], sums[2],
+                                       m, top_k)
+
+
 def compute_pair_correlation(correlation_function, rk1, rk2, top_k):
-    n = int(len(rk1))
-    total = 0
-    for i in range(n):
-        total += correlation_function(rk1[i][:top_k], rk2[i][:top_k], top_k)
-    return total/n
+    return float(np.mean(correlation_function(rk1, rk2, top_k)))
 
 
 def compute_tuple_correlation(correlation_function, rks, top_k):
-    n = int(len(rks[0]))
-    total = 0
-    for i in range(n):
-        rks_in = []
-        for j in range(len(rks)):
-            rks_in += [rks[j][i]]
-        total += correlation_function(rks_in, top_k)
-    return total/n
+    return float(np.mean(correlation_function(rks, top_k)))
 
 
-def compute_correlations_for_pairs(parameters,
-                                   correlation_function,
-                                   ranked_lists,
-                                   pairs,
-                                   top_k):
-    correlations = {}
+def compute_shared_pair_correlation(correlation_function,
+                                    index1,
+                                    index2,
+                                    top_k,
+                                    start,
+                                    end):
+    """
+    Returns the correlations of the queries in [start, end) of two
+    shared ranked lists matrices
+    """
+    rks = load_data.shared_ranked_lists
+    return correlation_function(rks[index1][start:end],
+                                rks[index2][start:end],
+                                top_k)
+
+
+def compute_shared_tuple_correlation(correlation_function, indexes, top_k):
+    rks = [load_data.shared_ranked_lists[index] for index in indexes]
+    return compute_tuple_correlation(correlation_function, rks, top_k)
+
+
+def compute_pairs_query_correlations(parameters,
+                                     correlation_function,
+                                     ranked_lists,
+                                     pairs,
+                                     top_k,
+                                     pool=None):
+    """
+    Returns a N x P matrix with the correlation of each query (row)
+    for each pair (column). A 'pool' of load_data.shared_ranked_lists_pool
+    with all the descriptors of 'ranked_lists' (in sorted order) can be
+    given to reuse it across calls.
+    """
+    if pool is None:
+        descriptors = sorted(set([desc for pair in pairs for desc in pair]))
+        with load_data.shared_ranked_lists_pool(parameters,
+                                                ranked_lists,
+                                                descriptors) as p:
+            return compute_pairs_query_correlations(
+                        parameters,
+                        correlation_function,
+                        {desc: ranked_lists[desc] for desc in descriptors},
+                        pairs,
+                        top_k,
+                        pool=p)
     print("\n Computing correlations...")
     n_pools = parameters["multithreading_pools"]
+    indexes = {desc: i for i, desc in enumerate(sorted(ranked_lists))}
+    # Split the queries in blocks when there are less pairs than pools
+    n = ranked_lists[pairs[0][0]].shape[0]
+    query_blocks = load_data.compute_query_blocks(n, len(pairs), n_pools)
     pool_params = [[correlation_function,
-                   ranked_lists[pair[0]],
-                   ranked_lists[pair[1]],
-                   top_k] for pair in pairs]
-    with Pool(n_pools) as p:
-        # Some print messages may not be reported while running pool map
-        output_correlations = p.starmap(compute_pair_correlation, pool_params)
-    for i, pair in enumerate(pairs):
-        correlations[str(pair)] = output_correlations[i]
+                   indexes[pair[0]],
+                   indexes[pair[1]],
+                   top_k,
+                   start,
+                   end] for pair in pairs for (start, end) in query_blocks]
+    output_correlations = pool.starmap(compute_shared_pair_correlation,
+                                       pool_params)
+    query_correlations = load_data.join_query_blocks(output_correlations,
+                                                     len(pairs),
+                                                     len(query_blocks))
     print(" Done!")
+    return query_correlations
+
+
+def average_query_correlations(pairs, query_correlations):
+    mean_correlations = np.mean(query_correlations, axis=0)
+    return {str(pair): float(mean_correlations[i])
+            for i, pair in enumerate(pairs)}
+
+
+def get_correlation_matrix(n_descriptors, pair_correlations):
+    """
+    Returns the symmetric D x D matrix of the pair correlations, given in
+    the order of tuples_processing.compute_possible_pairs (the diagonal
+    is not used)
+    """
+    correlations = np.zeros((n_descriptors, n_descriptors))
+    rows, cols = np.triu_indices(n_descriptors, 1)
+    correlations[rows, cols] = pair_correlations
+    correlations[cols, rows] = pair_correlations
     return correlations
 
 
+def compute_correlations_for_pairs(parameters,
+                                   correlation_function,
+                                   ranked_lists,
+                                   pairs,
+                                   top_k):
+    query_correlations = compute_pairs_query_correlations(parameters,
+                                                          correlation_function,
+                                                          ranked_lists,
+                                                          pairs,
+                                                          top_k)
+    return average_query_correlations(pairs, query_correlations)
+
+
 def compute_correlations_for_tuples(parameters,
                                     correlation_function,
                                     ranked_lists,
@@ -321,16 +766,102 @@ def compute_correlations_for_tuples(parameters,
     print("Running... ", tuples)
     correlations = {}
     print("\n Computing correlations...")
-    rks = []
-    for tup in tuples:
-        rks.append([ranked_lists[tup[i]] for i in range(len(tup))])
-    n_pools = parameters["multithreading_pools"]
+    descriptors = sorted(set([desc for tup in tuples for desc in tup]))
+    indexes = {desc: i for i, desc in enumerate(descriptors)}
     pool_params = [[correlation_function,
-                    rks[i], top_k] for i in range(len(tuples))]
-    with Pool(n_pools) as p:
-        # Some print messages may not be reported while running pool map
-        output_correlations = p.starmap(compute_tuple_correlation, pool_params)
+                    [indexes[desc] for desc in tup],
+                    top_k] for tup in tuples]
+    with load_data.shared_ranked_lists_pool(parameters,
+                                            ranked_lists,
+                                            descriptors) as p:
+        output_correlations = p.starmap(compute_shared_tuple_correlation,
+                                        pool_params)
     for i, tup in enumerate(tuples):
         correlations[str(tup)] = output_correlations[i]
     print(" Done!")
     return correlations
+
+
+def compute_correlation_sweep(correlation_measure,
+                              rks1,
+                              rks2,
+                              k_values,
+                              rbo_p=0.9):
+    """
+    Returns a N x len(k_values) matrix with the correlation of each query
+    for each k, all derived from a single computation of the prefix
+    overlaps up to max(k_values)
+    """
+    max_k = max(k_values)
+    overlaps = compute_overlaps(rks1[:, :max_k], rks2[:, :max_k])
+    depths = np.arange(1, overlaps.shape[1]+1)
+    k_values = np.array(k_values)
+    if correlation_measure == "jaccard":
+        return (overlaps/(2*depths - overlaps))[:, k_values-1]
+    if correlation_measure == "jaccard_k":
+        jaccard = np.cumsum(overlaps/(2*depths - overlaps), axis=1)
+        return jaccard[:, k_values-1]/k_values
+    rbo = (1-rbo_p)*np.cumsum((overlaps/depths)*(rbo_p**(depths-1)), axis=1)
+    rbo = rbo[:, k_values-1]
+    if correlation_measure == "rbo_ext":
+        rbo += (rbo_p**k_values)*overlaps[:, k_values-1]/k_values
+    return rbo
+
+
+def compute_shared_correlation_sweep(correlation_measure,
+                                     index1,
+                                     index2,
+                                     k_values,
+                                     rbo_p,
+                                     start,
+                                     end):
+    rks = load_data.shared_ranked_lists
+    return np.sum(compute_correlation_sweep(correlation_measure,
+                                            rks[index1][start:end],
+                                            rks[index2][start:end],
+                                            k_values,
+                                            rbo_p), axis=0)
+
+
+def compute_correlations_sweep_for_pairs(parameters,
+                                         correlation_measure,
+                                         ranked_lists,
+                                         pairs,
+                                         k_values):
+    """
+    Returns a dictionary {k: {pair: correlation}} for all the 'k_values',
+    given ranked lists loaded with at least max(k_values)
+    """
+    if correlation_measure not in ["jaccard", "jaccard_k", "rbo", "rbo_ext"]:
+        print("\n ERROR: Correlation measure not supported by the sweep:",
+              correlation_measure)
+        exit(1)
+    print("\n Computing correlations for each k...")
+    n_pools = parameters["multithreading_pools"]
+    descriptors = sorted(set([desc for pair in pairs for desc in pair]))
+    indexes = {desc: i for i, desc in enumerate(descriptors)}
+    n = ranked_lists[descriptors[0]].shape[0]
+    query_blocks = load_data.compute_query_blocks(n, len(pairs), n_pools)
+    pool_params = [[correlation_measure,
+                    indexes[pair[0]],
+                    indexes[pair[1]],
+                    k_values,
+                    parameters["rbo_p"],
+                    start,
+                    end] for pair in pairs for (start, end) in query_blocks]
+    with load_data.shared_ranked_lists_pool(parameters,
+                                            ranked_lists,
+                                            descriptors) as p:
+        output_correlations = p.starmap(compute_shared_correlation_sweep,
+                                        pool_params)
+    output_correlations = np.reshape(output_correlations,
+                                     (len(pairs),
+                                      len(query_blocks),
+                                      len(k_values)))
+    output_correlations = np.sum(output_correlations, axis=1)/n
+    correlations = {}
+    for j, k in enumerate(k_values):
+        correlations[k] = {str(pair): float(output_correlations[i, j])
+                           for i, pair in enumerate(pairs)}
+    print(" Done!")
+    return correlations
@@ -21,7 +21,9 @@
 #
 
 
-from multiprocessing import Pool
+import load_data
+import numpy as np
+from scipy.sparse import csr_matrix
 
 
 def get_effectiveness_func(effectiveness_estimation_measure):
@@ -36,38 +38,106 @@ def get_effectiveness_func(effectiveness_estimation_measure):
     exit(1)
 
 
-def compute_authority_score(ranked_lists, index, top_k):
-    score = 0
-    rk1 = ranked_lists[index][:top_k]
-    for img1 in rk1:
-        rk2 = ranked_lists[img1][:top_k]
-        for img2 in rk2:
-            for current_img in rk1:
-                if img2 == current_img:
-                    score += 1
-                    break
-    return (score/(top_k**2))
-
-
-def compute_reciprocal_score(ranked_lists, index, top_k):
-    score = 0
-    rk1 = ranked_lists[index][:top_k]
-    for img1 in rk1:
-        rk2 = ranked_lists[img1][:top_k]
-        for img2 in rk2:
-            for k, current_img in enumerate(rk1):
-                if img2 == current_img:
-                    score += 1/(k+1)
-                    break
-    return (score/(top_k**2))
+def compute_neighborhood_matrix(ranked_lists, top_k, weighted=False):
+    """
+    Returns the sparse N x N adjacency matrix of the top-k neighborhoods.
+    If 'weighted', the neighbor at position i is weighted by 1/(i+1).
+    """
+    rks = np.asarray(ranked_lists[:, :top_k], dtype=np.int64)
+    n, top_k = rks.shape
+    if weighted:
+        data = np.tile(1/np.arange(1, top_k+1), n)
+    else:
+        data = np.ones(n*top_k)
+    indptr = np.arange(0, n*top_k+1, top_k)
+    return csr_matrix((data, rks.ravel(), indptr), shape=(n, n))
+
+
+def compute_neighbors_score(adjacency,
+                            weights,
+                            top_k,
+                            start=0,
+                            end=None,
+                            block_size=1024):
+    """
+    For each query q in [start, end), sums the weights[q] of the neighbors
+    of each of its neighbors. Queries are processed in blocks to bound the
+    memory used by the sparse product.
+    """
+    if end is None:
+        end = adjacency.shape[0]
+    scores = np.zeros(end-start)
+    for i in range(start, end, block_size):
+        j = min(i+block_size, end)
+        reached = adjacency[i:j] @ adjacency
+        scores[i-start:j-start] = reached.multiply(weights[i:j]).sum(axis=1).A1
+    return scores/(top_k**2)
+
+
+def compute_authority_score(ranked_lists, top_k, start=0, end=None):
+    adjacency = compute_neighborhood_matrix(ranked_lists, top_k)
+    return compute_neighbors_score(adjacency, adjacency, top_k, start, end)
+
+
+def compute_reciprocal_score(ranked_lists, top_k, start=0, end=None):
+    adjacency = compute_neighborhood_matrix(ranked_lists, top_k)
+    weights = compute_neighborhood_matrix(ranked_lists, top_k, weighted=True)
+    return compute_neighbors_score(adjacency, weights, top_k, start, end)
 
 
 def compute_rk_effectiveness(effectiveness_function, ranked_lists, top_k):
-    n = int(len(ranked_lists))
-    total = 0
-    for index in range(n):
-        total += effectiveness_function(ranked_lists, index, top_k)
-    return total/n
+    return float(np.mean(effectiveness_function(ranked_lists, top_k)))
+
+
+def compute_shared_rk_effectiveness(effectiveness_function,
+                                    index,
+                                    top_k,
+                                    start,
+                                    end):
+    """
+    Returns the effectiveness scores of the queries in [start, end) of a
+    shared ranked lists matrix
+    """
+    ranked_lists = load_data.shared_ranked_lists[index]
+    return effectiveness_function(ranked_lists, top_k, start, end)
+
+
+def compute_descriptors_query_effectiveness(parameters,
+                                            effectiveness_function,
+                                            ranked_lists,
+                                            descriptors,
+                                            top_k):
+    """
+    Returns a N x D matrix with the effectiveness of each query (row)
+    for each descriptor (column)
+    """
+    print("\n Computing effectiveness estimations...")
+    n_pools = parameters["multithreading_pools"]
+    # Split the queries in blocks, so all the pools are used even
+    # when there are less descriptors than pools
+    n = ranked_lists[descriptors[0]].shape[0]
+    query_blocks = load_data.compute_query_blocks(n,
+                                                  len(descriptors),
+                                                  n_pools)
+    pool_params = [[effectiveness_function, i, top_k, start, end]
+                   for i in range(len(descriptors))
+                   for (start, end) in query_blocks]
+    with load_data.shared_ranked_lists_pool(parameters,
+                                            ranked_lists,
+                                            descriptors) as p:
+        output_effectiveness = p.starmap(compute_shared_rk_effectiveness,
+                                         pool_params)
+    query_effectiveness = load_data.join_query_blocks(output_effectiveness,
+                                                      len(descriptors),
+                                                      len(query_blocks))
+    print(" Done!")
+    return query_effectiveness
+
+
+def average_query_effectiveness(descriptors, query_effectiveness):
+    mean_effectiveness = np.mean(query_effectiveness, axis=0)
+    return {descriptor: float(mean_effectiveness[i])
+            for i, descriptor in enumerate(descriptors)}
 
 
 def compute_descriptors_effectiveness(parameters,
@@ -75,15 +145,100 @@ def compute_descriptors_effectiveness(parameters,
                                       ranked_lists,
                                       descriptors,
                                       top_k):
-    effectiveness = {}
-    print("\n Computing effectiveness estimations...")
+    query_effectiveness = compute_descriptors_query_effectiveness(
+                                                    parameters,
+                                                    effectiveness_function,
+                                                    ranked_lists,
+                                                    descriptors,
+                                                    top_k)
+    return average_query_effectiveness(descriptors, query_effectiveness)
+
+
+def compute_effectiveness_sweep(effectiveness_measure,
+                                ranked_lists,
+                                k_values,
+                                start=0,
+                                end=None,
+                                block_size=256):
+    """
+    Returns, for each k in 'k_values', the sum of the effectiveness scores
+    of the queries in [start, end), computed in a single pass.
+    The pair (neighbor i, its neighbor j) found at position p of the query
+    ranked list counts for every k deeper than i, j and p.
+    """
+    max_k = max(k_values)
+    rks = np.asarray(ranked_lists[:, :max_k], dtype=np.int64)
+    n, max_k = rks.shape
+    if end is None:
+        end = n
+    depths = np.arange(max_k)
+    pair_depths = np.maximum(depths[:, None], depths[None, :])
+    totals = np.zeros(max_k)
+    for i in range(start, end, block_size):
+        j = min(i+block_size, end)
+        rows = np.arange(j-i)
+        # Position (plus one) of each image in the ranked list of each query
+        table = np.zeros((j-i, n), dtype=np.int32)
+        table[rows[:, None], rks[i:j]] = depths+1
+        positions = table[rows[:, None, None], rks[rks[i:j]]] - 1
+        found = positions >= 0
+        entry_depths = np.maximum(pair_depths, positions)[found]
+        if effectiveness_measure == "reciprocal":
+            weights = 1/(positions[found]+1)
+        else:
+            weights = None
+        totals += np.bincount(entry_depths, weights=weights, minlength=max_k)
+    k_values = np.array(k_values)
+    return np.cumsum(totals)[k_values-1]/(k_values**2)
+
+
+def compute_shared_effectiveness_sweep(effectiveness_measure,
+                                       index,
+                                       k_values,
+                                       start,
+                                       end):
+    return compute_effectiveness_sweep(effectiveness_measure,
+                                       load_data.shared_ranked_lists[index],
+                                       k_values,
+                                       start,
+                                       end)
+
+
+def compute_descriptors_effectiveness_sweep(parameters,
+                                            effectiveness_measure,
+                                            ranked_lists,
+                                            descriptors,
+                                            k_values):
+    """
+    Returns a dictionary {k: {descriptor: effectiveness}} for all the
+    'k_values', given ranked lists loaded with at least max(k_values)
+    """
+    if effectiveness_measure not in ["authority", "reciprocal"]:
+        print("\n ERROR: Unknown effec. estim. measure:",
+              effectiveness_measure)
+        exit(1)
+    print("\n Computing effectiveness estimations for each k...")
     n_pools = parameters["multithreading_pools"]
-    pool_params = [[effectiveness_function, ranked_lists[descriptor], top_k]
-                   for descriptor in descriptors]
-    with Pool(n_pools) as p:
-        # Some print messages may not be reported while running pool map
-        output_effectiveness = p.starmap(compute_rk_effectiveness, pool_params)
-    for i, descriptor in enumerate(descriptors):
-        effectiveness[descriptor] = output_effectiveness[i]
+    n = ranked_lists[descriptors[0]].shape[0]
+    query_blocks = load_data.compute_query_blocks(n,
+                                                  len(descriptors),
+                                                  n_pools)
+    pool_params = [[effectiveness_measure, i, k_values, start, end]
+                   for i in range(len(descriptors))
+                   for (start, end) in query_blocks]
+    with load_data.shared_ranked_lists_pool(parameters,
+                                            ranked_lists,
+                                            descriptors) as p:
+        output_effectiveness = p.starmap(compute_shared_effectiveness_sweep,
+                                         pool_params)
+    output_effectiveness = np.reshape(output_effectiveness,
+                                      (len(descriptors),
+                                       len(query_blocks),
+                                       len(k_values)))
+    output_effectiveness = np.sum(output_effectiveness, axis=1)/n
+    effectiveness = {}
+    for j, k in enumerate(k_values):
+        effectiveness[k] = {descriptor: float(output_effectiveness[i, j])
+                            for i, descriptor in enumerate(descriptors)}
     print(" Done!")
     return effectiveness
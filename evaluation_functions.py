@@ -21,10 +21,86 @@
 #
 
 
-import rank_dictionaries
+import load_data
+import numpy as np
 from scipy.stats import pearsonr as compute_pearson
 
 
+def get_evaluation_precisions(parameters, l_size):
+    """
+    Values of k of P@k and Recall@k (top_k is always included, as it is
+    used by the "precision" supervised effectiveness)
+    """
+    precisions = set(parameters["evaluation_precisions"])
+    precisions.add(parameters["top_k"])
+    return sorted([k for k in precisions if 0 < k <= l_size])
+
+
+def compute_supervised_measures(ranked_lists, labels, precisions):
+    """
+    MAP, P@k (for each k in 'precisions') and the recall curve
+    (Recall@1 to Recall@L) of a N x L matrix of ranked lists, computed
+    in a single pass as in UDLF (class sizes taken from 'labels')
+    """
+    relevant = labels[ranked_lists] == labels[:, None]
+    class_sizes = np.bincount(labels)[labels]
+    hits = np.cumsum(relevant, axis=1)
+    positions = np.arange(1, ranked_lists.shape[1]+1)
+    average_precision = (np.sum(relevant*hits/positions, axis=1) /
+                         class_sizes)
+    mean_hits = np.mean(hits, axis=0)
+    recall = hits.T @ (1/class_sizes) / len(labels)
+    return {"map": float(np.mean(average_precision)),
+            "precision": {k: float(mean_hits[k-1]/k) for k in precisions},
+            "recall": recall}
+
+
+def get_named_measures(measures):
+    """
+    Flattens the output of compute_supervised_measures into the measure
+    names reported by UDLF ("MAP", "P@k" and "Recall@k")
+    """
+    named_measures = {"MAP": measures["map"]}
+    for k in measures["precision"]:
+        named_measures["P@" + str(k)] = measures["precision"][k]
+    for k in measures["precision"]:
+        named_measures["Recall@" + str(k)] = float(measures["recall"][k-1])
+    return named_measures
+
+
+def get_supervised_measure_name(parameters):
+    """
+    Name of parameters["supervised_effectiveness"] ("map" or "precision",
+    the P@top_k) in the dictionaries of get_named_measures and UDLF
+    """
+    if parameters["supervised_effectiveness"] == "precision":
+        return "P@" + str(parameters["top_k"])
+    return "MAP"
+
+
+def get_supervised_effectiveness(parameters, measures):
+    return measures[get_supervised_measure_name(parameters)]
+
+
+def evaluate_isolated_descriptors(parameters, dataset):
+    descriptors_measures = {}
+    print("\n Evaluating each descriptor...")
+    labels = load_data.load_labels(dataset)
+    precisions = get_evaluation_precisions(parameters, dataset["rk_size"])
+    # Evaluate the complete ranked lists (L = rk_size)
+    full_parameters = dict(parameters, top_k=dataset["rk_size"])
+    descriptors = load_data.list_descriptors(dataset["path_ranked_lists"])
+    for descriptor in descriptors:
+        ranked_lists = load_data.\
+            read_ranked_lists_file(full_parameters,
+                                   descriptor,
+                                   dataset["path_ranked_lists"])
+        descriptors_measures[descriptor] = get_named_measures(
+            compute_supervised_measures(ranked_lists, labels, precisions))
+    print(" Done!")
+    return descriptors_measures
+
+
 def compute_pearson_for_scores(parameters, selection_scores, map_scores):
     x = []
     y = []
@@ -61,8 +137,9 @@ def compute_virtual_baselines(map_scores):
 
 def compute_selection_case(selection_scores, map_scores):
     print("\n Computing selection case...")
-    selection_list = rank_dictionaries.\
-        rank_pairs_by_selection(selection_scores)
+    selection_list = sorted(selection_scores.items(),
+                            key=lambda x: x[1],
+                            reverse=True)
     selection_case = [[map_scores[combination[0]], combination[0]]
                       for combination in selection_list]
     print(" Done!")
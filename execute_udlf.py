@@ -21,15 +21,15 @@
 #
 
 
-import os
-import load_data
+import evaluation_functions
 from multiprocessing import Pool
-from udlf.udlf_calls import eval_supervised_effectiveness, fuse_tuple_cprr
+from udlf.udlf_calls import fuse_tuple_cprr
 
 
-def aggregate_pair_cprr(parameters, dataset, pair, exec_num):
+def aggregate_pair_cprr(parameters, dataset, pair):
     # print("\tExecuting fusion for", pair)
-    effectiveness_measure = parameters["supervised_effectiveness"]
+    precisions = evaluation_functions.\
+        get_evaluation_precisions(parameters, dataset["rk_size"])
     return fuse_tuple_cprr(pair,
                            dataset["path_ranked_lists"],
                            dataset["path_lists_file"],
@@ -38,57 +38,19 @@ def aggregate_pair_cprr(parameters, dataset, pair, exec_num):
                            num_iterations=1,
                            l_size=dataset["rk_size"],
                            top_k=parameters["top_k"],
-                           effectiveness_measure=effectiveness_measure,
-                           exec_num=exec_num)
+                           precisions=precisions,
+                           recall_at=parameters["top_k"])
 
 
 def execute_aggregation_cprr(parameters, dataset, pairs):
     pairs_map = {}
     print("\n Running CPRR (through UDLF) for each tuple...")
     n_pools = parameters["multithreading_pools"]
-    pool_params = list(zip(pairs, [x for x in range(len(pairs))]))
-    pool_params = [(parameters, dataset) + param for param in pool_params]
+    pool_params = [(parameters, dataset, pair) for pair in pairs]
     with Pool(n_pools) as p:
         # Some print messages may not be reported while running pool map
         output_pairs_map = p.starmap(aggregate_pair_cprr, pool_params)
-    # Remove all the config files generated by the executions in parallel
-    script_path = os.path.dirname(__file__)
-    os.system("rm " + os.path.join(script_path, "udlf/bin/config*"))
     # Parse dictionary with the results and return it
     pairs_map = dict(zip([str(pair) for pair in pairs], output_pairs_map))
     print(" Done!")
     return pairs_map
-
-
-def eval_descriptor(parameters, dataset, descriptor, exec_num):
-    # print("\tComputing for", descriptor)
-    path_file = os.path.join(dataset["path_ranked_lists"], descriptor) + ".txt"
-    return eval_supervised_effectiveness(
-            path_file,
-            dataset["path_lists_file"],
-            dataset["path_classes_file"],
-            dataset["size"],
-            effectiveness_measure=parameters["supervised_effectiveness"],
-            top_k=parameters["top_k"],
-            l_size=dataset["rk_size"],
-            exec_num=exec_num)
-
-
-def execute_eval_isolated_descriptors(parameters, dataset):
-    descriptors_map = {}
-    print("\n Evaluating MAP for each descriptor...")
-    n_pools = parameters["multithreading_pools"]
-    descriptors = load_data.list_descriptors(dataset["path_ranked_lists"])
-    pool_params = list(zip(descriptors, [x for x in range(len(descriptors))]))
-    pool_params = [(parameters, dataset) + param for param in pool_params]
-    with Pool(n_pools) as p:
-        # Some print messages may not be reported while running pool map
-        output_descriptors_map = p.starmap(eval_descriptor, pool_params)
-    # Remove all the config files generated by the executions in parallel
-    script_path = os.path.dirname(__file__)
-    os.system("rm " + os.path.join(script_path, "udlf/bin/config*"))
-    # Parse dictionary with the results and return it
-    descriptors_map = dict(zip([str(desc) for desc in descriptors],
-                               output_descriptors_map))
-    print(" Done!")
-    return descriptors_map
@@ -0,0 +1,211 @@
+# <fusion_functions.py>
+#
+#  @Author: Lucas Pascotti Valem <lucas.valem@unesp.br>
+#
+#-------------------------------------------------------------------------------
+#
+# This file is part of Unsupervised Selective Rank Fusion Framework (USRF).
+#
+# USRF is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# USRF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with USRF.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import load_data
+import evaluation_functions
+import time
+import numpy as np
+
+
+def fill_positions_matrix(matrix, ranked_lists):
+    """
+    Initial CPRR similarities: each element at position p of a list
+    of size L adds L-p to both (query, element) and (element, query)
+    """
+    n, l_size = ranked_lists.shape
+    rows = np.repeat(np.arange(n), l_size)
+    cols = ranked_lists.ravel()
+    weights = np.tile(np.arange(l_size, 0, -1), n).astype(np.float32)
+    np.add.at(matrix, (rows, cols), weights)
+    np.add.at(matrix, (cols, rows), weights)
+
+
+def move_queries_to_top(ranked_lists):
+    """
+    Swaps each query with the first element of its own ranked list
+    """
+    queries = np.arange(ranked_lists.shape[0])
+    found = ranked_lists == queries[:, None]
+    positions = np.argmax(found, axis=1)
+    moved = found[queries, positions] & (positions > 0)
+    queries = queries[moved]
+    positions = positions[moved]
+    ranked_lists[queries, positions] = ranked_lists[queries, 0]
+    ranked_lists[queries, 0] = queries
+
+
+def sort_ranked_lists(matrix, ranked_lists, reset_scores=True):
+    """
+    Sorts the ranked lists by the similarities in 'matrix' (ties keep
+    the current order). When 'reset_scores' is set, the similarities of
+    the listed elements are zeroed for the next iteration.
+    """
+    rows = np.arange(ranked_lists.shape[0])[:, None]
+    scores = matrix[rows, ranked_lists]
+    if reset_scores:
+        matrix[rows, ranked_lists] = 0
+    order = np.argsort(-scores, axis=1, kind='stable')
+    ranked_lists = np.take_along_axis(ranked_lists, order, axis=1)
+    move_queries_to_top(ranked_lists)
+    return ranked_lists
+
+
+def compute_cartesian_product(matrix, ranked_lists, top_k):
+    """
+    Adds the cartesian product of the top_k neighborhood of each query
+    (query included) and of each reverse neighborhood, weighted by the
+    positions of the elements
+    """
+    n = ranked_lists.shape[0]
+    weights = np.arange(top_k, 0, -1).astype(np.float32)
+    neighbors = ranked_lists[:, :top_k].copy()
+    neighbors[:, 0] = np.arange(n)
+    products = np.broadcast_to(2*np.outer(weights, weights),
+                               (n, top_k, top_k))
+    np.add.at(matrix,
+              (neighbors[:, :, None], neighbors[:, None, :]),
+              products)
+
+    # Reverse neighborhoods: group the queries by each of their neighbors
+    targets = ranked_lists[:, 1:top_k].ravel()
+    order = np.argsort(targets, kind='stable')
+    targets = targets[order]
+    sources = np.repeat(np.arange(n), top_k-1)[order]
+    source_weights = np.tile(weights[1:], n)[order]
+    counts = np.bincount(targets, minlength=n)
+    starts = np.cumsum(counts) - counts
+    group_counts = counts[targets]
+    left = np.repeat(np.arange(targets.size), group_counts)
+    offsets = (np.arange(left.size) -
+               np.repeat(np.cumsum(group_counts) - group_counts, group_counts))
+    right = starts[targets[left]] + offsets
+    np.add.at(matrix,
+              (sources[left], sources[right]),
+              2*source_weights[left]*source_weights[right])
+
+
+def perform_cprr_iterations(matrix, ranked_lists, top_k, num_iterations):
+    for iteration in range(1, num_iterations+1):
+        compute_cartesian_product(matrix, ranked_lists, top_k)
+        # The similarities are kept after the last iteration
+        last_iteration = iteration == num_iterations
+        ranked_lists = sort_ranked_lists(matrix,
+                                         ranked_lists,
+                                         reset_scores=not last_iteration)
+    return ranked_lists
+
+
+def compute_cprr(ranked_lists, top_k, l_size, num_iterations):
+    """
+    Cartesian Product of Ranking References (CPRR) over a N x L matrix of
+    ranked lists, following the UDLF implementation.
+    Returns the ranked lists and the dense N x N similarity matrix.
+    """
+    n = ranked_lists.shape[0]
+    ranked_lists = np.array(ranked_lists[:, :l_size], dtype=np.intp)
+    matrix = np.zeros((n, n), dtype=np.float32)
+    fill_positions_matrix(matrix, ranked_lists)
+    ranked_lists = sort_ranked_lists(matrix, ranked_lists)
+    ranked_lists = perform_cprr_iterations(matrix,
+                                           ranked_lists,
+                                           top_k,
+                                           num_iterations)
+    return ranked_lists, matrix
+
+
+def compute_cprr_fusion(ranked_lists, top_k, l_size, num_iterations):
+    """
+    Rank fusion with CPRR, following the UDLF implementation: the
+    similarity matrices of CPRR on each ranked lists matrix are summed,
+    the union of the lists of each query is sorted by the summed
+    similarities and two final CPRR iterations are performed
+    (regardless of 'num_iterations').
+    """
+    n = ranked_lists[0].shape[0]
+    fused_matrix = np.zeros((n, n), dtype=np.float32)
+    for rks in ranked_lists:
+        _, matrix = compute_cprr(rks, top_k, l_size, num_iterations)
+        fused_matrix += matrix
+        del matrix
+
+    # Union of the lists, in the order the elements first appear
+    union = np.hstack([np.asarray(rks[:, :l_size], dtype=np.intp)
+                       for rks in ranked_lists])
+    order = np.argsort(union, axis=1, kind='stable')
+    sorted_union = np.take_along_axis(union, order, axis=1)
+    repeated = np.zeros(union.shape, dtype=bool)
+    repeated[:, 1:] = sorted_union[:, 1:] == sorted_union[:, :-1]
+    np.put_along_axis(repeated, order, repeated.copy(), axis=1)
+
+    # Repeated elements are sent to the end of the lists
+    scores = fused_matrix[np.arange(n)[:, None], union]
+    scores[repeated] = -np.inf
+    order = np.argsort(-scores, axis=1, kind='stable')
+    union = np.take_along_axis(union, order, axis=1)
+    move_queries_to_top(union)
+    fused_lists = union[:, :l_size].copy()
+    return perform_cprr_iterations(fused_matrix, fused_lists, top_k, 2)
+
+
+def aggregate_shared_tuple_cprr(parameters, labels, tup, l_size):
+    # Runs inside the pool workers (see load_data.attach_shared_ranked_lists)
+    ranked_lists = [load_data.shared_ranked_lists[i] for i in tup]
+    start_time = time.time()
+    fused_lists = compute_cprr_fusion(ranked_lists,
+                                      parameters["top_k"],
+                                      l_size,
+                                      num_iterations=1)
+    elapsed = time.time() - start_time
+    precisions = evaluation_functions.get_evaluation_precisions(parameters,
+                                                                l_size)
+    measures = evaluation_functions.get_named_measures(
+        evaluation_functions.compute_supervised_measures(fused_lists,
+                                                         labels,
+                                                         precisions))
+    measures["Time"] = elapsed
+    return measures
+
+
+def execute_aggregation_cprr(parameters, dataset, tuples):
+    print("\n Running CPRR (native) for each tuple...")
+    labels = load_data.load_labels(dataset)
+    descriptors = sorted(set([desc for tup in tuples for desc in tup]))
+    indexes = {desc: i for i, desc in enumerate(descriptors)}
+    # CPRR uses the complete ranked lists (L = rk_size)
+    ranked_lists = {desc: load_data.read_ranked_lists_file(
+                              dict(parameters, top_k=dataset["rk_size"]),
+                              desc,
+                              dataset["path_ranked_lists"])
+                    for desc in descriptors}
+    pool_params = [[parameters,
+                    labels,
+                    [indexes[desc] for desc in tup],
+                    dataset["rk_size"]] for tup in tuples]
+    with load_data.shared_ranked_lists_pool(parameters,
+                                            ranked_lists,
+                                            descriptors) as p:
+        output_tuples_map = p.starmap(aggregate_shared_tuple_cprr,
+                                      pool_params)
+    tuples_map = dict(zip([str(tup) for tup in tuples], output_tuples_map))
+    print(" Done!")
+    return tuples_map
@@ -22,26 +22,375 @@
 
 
 import os
+import json
+import time
+import hashlib
+import numpy as np
+from contextlib import contextmanager
+from multiprocessing import Pool, shared_memory
+
+# Ranked lists attached by pool workers (see attach_shared_ranked_lists)
+shared_blocks = []
+shared_ranked_lists = []
+
+# Labels of the datasets already loaded (see load_labels)
+loaded_labels = {}
 
 
 def list_descriptors(path):
     return [x[:-4] for x in sorted(os.listdir(path))]
 
 
+def compute_file_fingerprint(file_path):
+    """
+    Returns the SHA-1 digest of the contents of the file 'file_path'
+    """
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def get_cache_file(parameters, file_path, folder="ranked_lists"):
+    """
+    Returns the path (without extension) used to cache data derived
+    from 'file_path' inside the 'folder' of the cache directory
+    """
+    file_path = os.path.abspath(file_path)
+    path_key = hashlib.sha1(file_path.encode()).hexdigest()[:12]
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    cache_path = os.path.join(parameters["cache_dir"], folder)
+    os.makedirs(cache_path, exist_ok=True)
+    return os.path.join(cache_path, name + "_" + path_key)
+
+
+def compute_file_chunks(file_path, chunk_size):
+    """
+    Splits the file 'file_path' into byte ranges of approximately
+    'chunk_size' bytes, always ending on line boundaries
+    """
+    chunks = []
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        start = 0
+        while start < file_size:
+            f.seek(min(start + chunk_size, file_size))
+            f.readline()
+            end = f.tell()
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def parse_ranked_lists_chunk(file_path, start, end):
+    """
+    Converts the lines between the bytes 'start' and 'end' of a ranked
+    lists file (one ranked list per line) into a n x L matrix, where L
+    is the number of values in the first line of the chunk
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start).strip()
+    if data == b'':
+        return np.empty((0, 0), dtype=np.int64)
+    # Count the values of each line to verify that all have the same size
+    chars = np.frombuffer(data, dtype=np.uint8)
+    spaces = chars <= ord(' ')
+    value_starts = ~spaces
+    value_starts[1:] &= spaces[:-1]
+    line_starts = np.flatnonzero(chars == ord('\n')) + 1
+    line_starts = np.concatenate(([0], line_starts))
+    line_sizes = np.add.reduceat(value_starts.view(np.uint8),
+                                 line_starts,
+                                 dtype=np.int32)
+    n_lines = len(line_starts)
+    if line_sizes[0] == 0 or np.any(line_sizes != line_sizes[0]):
+        print("\n ERROR: Ranked lists with different sizes in", file_path)
+        exit(1)
+    try:
+        values = np.fromstring(data.decode(), dtype=np.int64, sep=' ')
+    except ValueError:
+        values = np.empty(0, dtype=np.int64)
+    if values.size != line_sizes.sum():
+        print("\n ERROR: Invalid values in the ranked lists of", file_path)
+        exit(1)
+    return values.reshape(n_lines, line_sizes[0])
+
+
+def merge_ranked_lists_chunks(file_path, chunks):
+    """
+    Concatenates the parsed chunks of a file into a single N x L matrix
+    using the smallest integer type able to store the image ids
+    """
+    chunks = [chunk for chunk in chunks if chunk.size > 0]
+    if chunks == []:
+        print("\n ERROR: Empty ranked lists file", file_path)
+        exit(1)
+    if len(set([chunk.shape[1] for chunk in chunks])) != 1:
+        print("\n ERROR: Ranked lists with different sizes in", file_path)
+        exit(1)
+    values = np.concatenate(chunks)
+    if values.max() <= np.iinfo(np.uint16).max:
+        return values.astype(np.uint16)
+    return values.astype(np.int32)
+
+
+def get_file_stats(file_path):
+    stats = os.stat(file_path)
+    return {"size": stats.st_size, "mtime": stats.st_mtime_ns}
+
+
+def is_cache_valid(file_path, cache_file):
+    """
+    Verifies if the cached matrix of 'file_path' is up to date.
+    The file hash is only computed when its size or mtime changed.
+    """
+    if not (os.path.isfile(cache_file + ".npy") and
+            os.path.isfile(cache_file + ".json")):
+        return False
+    with open(cache_file + ".json", 'r') as f:
+        metadata = json.load(f)
+    stats = get_file_stats(file_path)
+    if (metadata["size"] == stats["size"] and
+            metadata["mtime"] == stats["mtime"]):
+        return True
+    if metadata["fingerprint"] != compute_file_fingerprint(file_path):
+        return False
+    # The file was touched but not modified, just update the stats
+    metadata.update(stats)
+    write_json(metadata, cache_file + ".json")
+    return True
+
+
+def write_json(data, out_file):
+    tmp_file = out_file + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_file, out_file)
+
+
+def save_ranked_lists_cache(file_path, cache_file, stats, matrix):
+    """
+    Stores the binary .npy matrix of 'file_path' in 'cache_file',
+    along with its fingerprint metadata
+    """
+    # Write to temporary files first, so concurrent runs never see
+    # a partially written cache
+    tmp_file = cache_file + "." + str(os.getpid()) + ".tmp.npy"
+    np.save(tmp_file, matrix)
+    os.replace(tmp_file, cache_file + ".npy")
+    metadata = {"fingerprint": compute_file_fingerprint(file_path),
+                "shape": list(matrix.shape),
+                "dtype": str(matrix.dtype)}
+    metadata.update(stats)
+    write_json(metadata, cache_file + ".json")
+
+
+def convert_ranked_lists_files(parameters, file_paths, cache_files):
+    """
+    Converts the text files in 'file_paths' into binary matrices.
+    Files are split on line boundaries and all the chunks of all the
+    files are parsed in parallel.
+    """
+    n_pools = parameters["multithreading_pools"]
+    stats = [get_file_stats(file_path) for file_path in file_paths]
+    pool_params = []
+    for file_path, file_stats in zip(file_paths, stats):
+        chunk_size = max(1 << 20, -(-file_stats["size"] // n_pools))
+        pool_params.append([(file_path, start, end) for (start, end)
+                            in compute_file_chunks(file_path, chunk_size)])
+    start_time = time.time()
+    with Pool(n_pools) as p:
+        # Some print messages may not be reported while running pool map
+        output_chunks = p.starmap(parse_ranked_lists_chunk,
+                                  [param for params in pool_params
+                                   for param in params])
+    n_lines = 0
+    for i, file_path in enumerate(file_paths):
+        file_chunks = output_chunks[:len(pool_params[i])]
+        output_chunks = output_chunks[len(pool_params[i]):]
+        matrix = merge_ranked_lists_chunks(file_path, file_chunks)
+        save_ranked_lists_cache(file_path, cache_files[i], stats[i], matrix)
+        n_lines += matrix.shape[0]
+    elapsed = max(time.time() - start_time, 1e-9)
+    print("\tParsed", n_lines, "lines in", "%0.2f" % elapsed, "seconds (",
+          int(n_lines/elapsed), "lines/s )")
+
+
+def get_ranked_lists_fingerprint(parameters, descriptor, path_rks):
+    """
+    Returns the fingerprint of the ranked lists file of 'descriptor',
+    reusing the one stored with its binary cache when it is up to date
+    """
+    file_path = os.path.join(path_rks, descriptor) + ".txt"
+    cache_file = get_cache_file(parameters, file_path)
+    if not is_cache_valid(file_path, cache_file):
+        return compute_file_fingerprint(file_path)
+    with open(cache_file + ".json", 'r') as f:
+        return json.load(f)["fingerprint"]
+
+
 def read_ranked_lists_file(parameters, descriptor, path_rks):
     file_path = os.path.join(path_rks, descriptor) + ".txt"
-    print("\tReading file", file_path)
-    with open(file_path, 'r') as f:
-        return [[int(y) for y in x.strip().split(' ')][:parameters["top_k"]]
-                for x in f.readlines()]
+    cache_file = get_cache_file(parameters, file_path)
+    if not is_cache_valid(file_path, cache_file):
+        print("\tConverting file", file_path)
+        convert_ranked_lists_files(parameters, [file_path], [cache_file])
+    ranked_lists = np.load(cache_file + ".npy", mmap_mode='r')
+    return ranked_lists[:, :parameters["top_k"]]
 
 
 def load_ranked_lists(parameters, descriptors, path_rks):
     ranked_lists = {}
     print("\n Loading ranked lists...")
+    # Convert all the new or modified files at once
+    file_paths = []
+    cache_files = []
+    for descriptor in descriptors:
+        file_path = os.path.join(path_rks, descriptor) + ".txt"
+        cache_file = get_cache_file(parameters, file_path)
+        if not is_cache_valid(file_path, cache_file):
+            print("\tConverting file", file_path)
+            file_paths.append(file_path)
+            cache_files.append(cache_file)
+        else:
+            print("\tReading cached file", file_path)
+    if len(file_paths) > 0:
+        convert_ranked_lists_files(parameters, file_paths, cache_files)
     for descriptor in descriptors:
         ranked_lists[descriptor] = read_ranked_lists_file(parameters,
                                                           descriptor,
                                                           path_rks)
     print(" Done!")
     return ranked_lists
+
+
+def load_labels(dataset):
+    """
+    Returns the class of each image (in the order of the lists file)
+    as an array of integer labels. The files are only read once.
+    """
+    key = (dataset["path_lists_file"], dataset["path_classes_file"])
+    if key in loaded_labels:
+        return loaded_labels[key]
+    with open(dataset["path_lists_file"], 'r') as f:
+        images = [line.strip() for line in f if line.strip() != '']
+    classes = {}
+    with open(dataset["path_classes_file"], 'r') as f:
+        for line in f:
+            if line.strip() != '':
+                image, image_class = line.strip().rsplit(':', 1)
+                classes[image] = image_class
+    missing = [image for image in images if image not in classes]
+    if missing != []:
+        print("\n ERROR: Images without class in",
+              dataset["path_classes_file"], ":", missing[:5])
+        exit(1)
+    _, labels = np.unique([classes[image] for image in images],
+                          return_inverse=True)
+    loaded_labels[key] = labels
+    return labels
+
+
+def save_query_scores(parameters,
+                      dataset,
+                      descriptors,
+                      pairs,
+                      query_effectiveness,
+                      query_correlations):
+    """
+    Exports the N x D effectiveness and N x P correlation matrices of the
+    queries as float32 arrays, with the settings used to compute them
+    """
+    filename = "query_scores_" + dataset["name"] + ".npz"
+    print("\n Exporting per-query scores to " + filename + "...")
+    np.savez(filename,
+             descriptors=np.array(descriptors),
+             pairs=np.array(pairs).reshape(-1, 2),
+             effectiveness=query_effectiveness.astype(np.float32),
+             correlations=query_correlations.astype(np.float32),
+             effectiveness_measure=parameters[
+                                    "effectiveness_estimation_measure"],
+             correlation_measure=parameters["correlation_measure"],
+             top_k=parameters["top_k"])
+    print(" Done!")
+
+
+def compute_query_blocks(n_queries, n_items, n_pools):
+    """
+    Splits the queries in contiguous blocks [start, end), so that the
+    tasks of 'n_items' (descriptors, pairs) split in these blocks are
+    enough to keep 'n_pools' busy
+    """
+    n_blocks = min(max(1, -(-n_pools // max(n_items, 1))), n_queries)
+    bounds = np.linspace(0, n_queries, n_blocks+1).astype(int)
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1],
+                                                         bounds[1:])]
+
+
+def share_ranked_lists(ranked_lists, descriptors):
+    """
+    Copies the ranked lists of 'descriptors' once into shared memory, so
+    pool workers can access them by index instead of receiving a pickled
+    copy with every task. Returns the shared memory blocks, which must be
+    released with release_shared_ranked_lists, and the information
+    required by attach_shared_ranked_lists.
+    """
+    blocks = []
+    shared_info = []
+    for descriptor in descriptors:
+        rks = np.ascontiguousarray(ranked_lists[descriptor])
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(rks.nbytes, 1))
+        np.ndarray(rks.shape, dtype=rks.dtype, buffer=block.buf)[:] = rks
+        blocks.append(block)
+        shared_info.append((block.name, rks.shape, rks.dtype.str))
+    return blocks, shared_info
+
+
+def attach_shared_ranked_lists(shared_info):
+    """
+    Pool initializer that attaches the shared ranked lists as zero-copy
+    arrays in shared_ranked_lists (in the same order of 'shared_info')
+    """
+    for name, shape, dtype in shared_info:
+        block = shared_memory.SharedMemory(name=name)
+        shared_blocks.append(block)
+        shared_ranked_lists.append(np.ndarray(shape, dtype=dtype,
+                                              buffer=block.buf))
+
+
+def release_shared_ranked_lists(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+@contextmanager
+def shared_ranked_lists_pool(parameters, ranked_lists, descriptors):
+    """
+    Shares the ranked lists of 'descriptors' and yields a pool whose
+    workers access them by their index in 'descriptors' (tasks only
+    receive indexes to the ranked lists in shared memory). The shared
+    memory is released when the pool is closed.
+    """
+    blocks, shared_info = share_ranked_lists(ranked_lists, descriptors)
+    try:
+        with Pool(parameters["multithreading_pools"],
+                  attach_shared_ranked_lists,
+                  (shared_info,)) as p:
+            # Some print messages may not be reported while running pool map
+            yield p
+    finally:
+        release_shared_ranked_lists(blocks)
+
+
+def join_query_blocks(output_blocks, n_items, n_blocks):
+    """
+    Joins the outputs of the query blocks of each item (descriptor, pair)
+    as the columns of a N x n_items matrix
+    """
+    columns = [np.concatenate(output_blocks[i*n_blocks:(i+1)*n_blocks])
+               for i in range(n_items)]
+    return np.stack(columns, axis=1).astype(np.float64)
@@ -22,12 +22,70 @@
 
 
 import numpy as np
+from scipy.stats import rankdata
+
+
+def compute_rank_correlations(scores, reference):
+    """
+    Spearman correlation between each row of 'scores' (G x P) and the
+    'reference' scores (P), with tied scores sharing their average rank
+    """
+    ranks = rankdata(scores, axis=1)
+    reference_ranks = rankdata(reference)
+    ranks -= np.mean(ranks, axis=1, keepdims=True)
+    reference_ranks -= np.mean(reference_ranks)
+    covariance = ranks @ reference_ranks
+    norms = np.linalg.norm(ranks, axis=1)*np.linalg.norm(reference_ranks)
+    return covariance/np.maximum(norms, 1e-12)
 
 
 def estimate_beta(parameters, effectiveness, correlations):
+    """
+    Chooses, among the values of parameters["beta_grid"], the beta whose
+    ranking of pairs agrees the most with both the effectiveness-only and
+    the correlation-only rankings, i.e. the value that maximizes the
+    smallest of the two Spearman correlations.
+    The sign of the configured beta defines the correlation-only ranking:
+    lowest correlation first (diversity) for beta >= 0 and highest
+    correlation first for beta < 0, as in the selection score. The
+    estimation keeps this regime (only the values of the grid with the
+    same sign are evaluated) and tunes the magnitude of beta.
+    Only the effectiveness vector and the correlation matrix are used.
+    """
     print("\n Estimating values for beta...")
-    print(" This estimation is currently NOT IMPLEMENTED!")
-    print(" Aborting execution...")
-    exit(1)
+    rows, cols = np.triu_indices(len(effectiveness), 1)
+    if len(rows) < 2:
+        print(" WARNING: Not enough pairs to estimate beta, keeping",
+              parameters["beta"])
+        return parameters["beta"]
+    eff_scores = effectiveness[rows]*effectiveness[cols]
+    cor_scores = correlations[rows, cols]
+    grid = np.round(np.linspace(*parameters["beta_grid"]), 10)
+    if parameters["beta"] >= 0:
+        cor_reference = -cor_scores
+        betas = grid[grid >= 0]
+    else:
+        cor_reference = cor_scores
+        betas = grid[grid < 0]
+    if len(betas) == 0:
+        print(" WARNING: beta_grid has no values with the sign of beta,",
+              "keeping", parameters["beta"])
+        return parameters["beta"]
+    # Ties are broken by the smallest magnitude of beta
+    betas = betas[np.argsort(np.abs(betas), kind='stable')]
 
-    return 0
+    # Selection scores of all pairs for all the values of beta at once
+    with np.errstate(invalid='ignore', divide='ignore'):
+        selection = (eff_scores[None, :] /
+                     ((1 + cor_scores[None, :])**betas[:, None]))
+    agreement = np.minimum(compute_rank_correlations(selection, eff_scores),
+                           compute_rank_correlations(selection, cor_reference))
+    # Betas with undefined scores (1 + cor <= 0) can not be selected
+    agreement[np.any(~np.isfinite(selection), axis=1)] = -np.inf
+    beta = float(betas[np.argmax(agreement)])
+    if beta in [grid[0], grid[-1]]:
+        print(" WARNING: The estimated beta is an endpoint of beta_grid,",
+              "consider extending the grid")
+    print(" Estimated beta:", beta)
+    print(" Done!")
+    return beta
@@ -21,22 +21,33 @@
 #
 
 
-def rank_descriptors_by_effec_estim(effectiveness):
-    effec_rk = [[desc, effectiveness[desc]] for desc in effectiveness]
-    effec_rk = sorted(effec_rk, key=lambda x: x[1], reverse=True)
-    return effec_rk
+import numpy as np
+
+
+def rank_descriptors_by_effec_estim(descriptors, effectiveness):
+    order = np.argsort(-effectiveness, kind='stable')
+    return [[descriptors[i], float(effectiveness[i])] for i in order]
+
+
+def rank_pairs_matrix(matrix, reverse=False):
+    """
+    Ranks the pairs (i, j), i < j, of a symmetric D x D matrix by value.
+    Ties keep the order of tuples_processing.compute_possible_pairs.
+    Pairs that were not computed (NaN) are left out.
+    """
+    rows, cols = np.triu_indices(matrix.shape[0], 1)
+    values = matrix[rows, cols]
+    order = np.argsort(-values if reverse else values, kind='stable')
+    order = order[~np.isnan(values[order])]
+    return [[(int(rows[k]), int(cols[k])), float(values[k])] for k in order]
 
 
 def rank_pairs_by_correlation(correlations):
-    cor_rk = [[pair, correlations[str(pair)]] for pair in correlations]
-    cor_rk = sorted(cor_rk, key=lambda x: x[1])
-    return cor_rk
+    return rank_pairs_matrix(correlations)
 
 
 def rank_pairs_by_selection(selection):
-    sel_rk = [[pair, selection[str(pair)]] for pair in selection]
-    sel_rk = sorted(sel_rk, key=lambda x: x[1], reverse=True)
-    return sel_rk
+    return rank_pairs_matrix(selection, reverse=True)
 
 
 def rank_pairs_by_map(pairs_map):
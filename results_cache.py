@@ -0,0 +1,263 @@
+# <results_cache.py>
+#
+#  @Author: Lucas Pascotti Valem <lucas.valem@unesp.br>
+#
+#-------------------------------------------------------------------------------
+#
+# This file is part of Unsupervised Selective Rank Fusion Framework (USRF).
+#
+# USRF is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# USRF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with USRF.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import os
+import json
+import hashlib
+import numpy as np
+import load_data
+import evaluation_functions
+import correlation_functions
+import effectiveness_estimation_functions
+
+
+def get_cache_key(*fields):
+    """
+    Returns a key that identifies the content of the given fields
+    """
+    return hashlib.sha1(json.dumps(fields).encode()).hexdigest()
+
+
+def get_results_path(parameters):
+    results_path = os.path.join(parameters["cache_dir"], "results")
+    os.makedirs(results_path, exist_ok=True)
+    return results_path
+
+
+def is_cache_enabled(parameters):
+    return parameters["cache_max_size_mb"] > 0
+
+
+def load_cached_array(parameters, key):
+    """
+    Returns the array stored with 'key' or None if it is not cached.
+    Hits update the file mtime, which is used as the LRU order.
+    """
+    cache_file = os.path.join(get_results_path(parameters), key + ".npy")
+    try:
+        array = np.load(cache_file)
+        os.utime(cache_file)
+    except (OSError, ValueError):
+        return None
+    return array
+
+
+def store_cached_array(parameters, key, array):
+    cache_file = os.path.join(get_results_path(parameters), key + ".npy")
+    # Write to a temporary file first, so concurrent runs never see
+    # a partially written result
+    tmp_file = cache_file + "." + str(os.getpid()) + ".tmp.npy"
+    np.save(tmp_file, array)
+    os.replace(tmp_file, cache_file)
+
+
+def evict_cache(parameters):
+    """
+    Removes the least recently used results until the cache size is
+    below parameters["cache_max_size_mb"]
+    """
+    max_size = parameters["cache_max_size_mb"]*(1 << 20)
+    entries = []
+    with os.scandir(get_results_path(parameters)) as it:
+        for entry in it:
+            if entry.is_file():
+                stats = entry.stat()
+                entries.append((stats.st_mtime, stats.st_size, entry.path))
+    total_size = sum([entry[1] for entry in entries])
+    for mtime, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_size -= size
+
+
+def get_fingerprints(parameters, dataset, descriptors):
+    return {descriptor: load_data.get_ranked_lists_fingerprint(
+                                            parameters,
+                                            descriptor,
+                                            dataset["path_ranked_lists"])
+            for descriptor in descriptors}
+
+
+def get_correlation_parameters(parameters):
+    """
+    Parameters that change the result of the correlation measure
+    """
+    if parameters["correlation_measure"] in ["rbo", "rbo_ext"]:
+        return {"rbo_p": parameters["rbo_p"]}
+    return {}
+
+
+def compute_cached_query_effectiveness(parameters,
+                                       dataset,
+                                       effectiveness_function,
+                                       ranked_lists,
+                                       descriptors):
+    """
+    Same as compute_descriptors_query_effectiveness, but only computes
+    the descriptors whose results are not in the cache
+    """
+    top_k = parameters["top_k"]
+    if not is_cache_enabled(parameters):
+        return effectiveness_estimation_functions.\
+            compute_descriptors_query_effectiveness(parameters,
+                                                    effectiveness_function,
+                                                    ranked_lists,
+                                                    descriptors,
+                                                    top_k)
+    fingerprints = get_fingerprints(parameters, dataset, descriptors)
+    keys = [get_cache_key("effectiveness",
+                          fingerprints[descriptor],
+                          parameters["effectiveness_estimation_measure"],
+                          top_k) for descriptor in descriptors]
+    cached = [load_cached_array(parameters, key) for key in keys]
+    missing = [i for i, scores in enumerate(cached) if scores is None]
+    print("\n Found cached effectiveness for",
+          len(descriptors)-len(missing), "of", len(descriptors),
+          "descriptors")
+    if len(missing) > 0:
+        computed = effectiveness_estimation_functions.\
+            compute_descriptors_query_effectiveness(
+                                    parameters,
+                                    effectiveness_function,
+                                    ranked_lists,
+                                    [descriptors[i] for i in missing],
+                                    top_k)
+        for j, i in enumerate(missing):
+            cached[i] = computed[:, j]
+            store_cached_array(parameters, keys[i], cached[i])
+    evict_cache(parameters)
+    return np.stack(cached, axis=1)
+
+
+def compute_cached_query_correlations(parameters,
+                                      dataset,
+                                      correlation_function,
+                                      ranked_lists,
+                                      pairs,
+                                      pool=None):
+    """
+    Same as compute_pairs_query_correlations, but only computes the pairs
+    whose results are not in the cache
+    """
+    top_k = parameters["top_k"]
+    if not is_cache_enabled(parameters):
+        return correlation_functions.\
+            compute_pairs_query_correlations(parameters,
+                                             correlation_function,
+                                             ranked_lists,
+                                             pairs,
+                                             top_k,
+                                             pool=pool)
+    descriptors = sorted(set([desc for pair in pairs for desc in pair]))
+    fingerprints = get_fingerprints(parameters, dataset, descriptors)
+    keys = [get_cache_key("correlation",
+                          fingerprints[pair[0]],
+                          fingerprints[pair[1]],
+                          parameters["correlation_measure"],
+                          top_k,
+                          get_correlation_parameters(parameters))
+            for pair in pairs]
+    cached = [load_cached_array(parameters, key) for key in keys]
+    missing = [i for i, scores in enumerate(cached) if scores is None]
+    print("\n Found cached correlations for",
+          len(pairs)-len(missing), "of", len(pairs), "pairs")
+    if len(missing) > 0:
+        computed = correlation_functions.\
+            compute_pairs_query_correlations(parameters,
+                                             correlation_function,
+                                             ranked_lists,
+                                             [pairs[i] for i in missing],
+                                             top_k,
+                                             pool=pool)
+        for j, i in enumerate(missing):
+            cached[i] = computed[:, j]
+            store_cached_array(parameters, keys[i], cached[i])
+    evict_cache(parameters)
+    return np.stack(cached, axis=1)
+
+
+def get_measures_array(measures):
+    """
+    Stores a dictionary {measure: value} as a structured array
+    """
+    dtype = [(name, np.float64) for name in measures]
+    return np.array(tuple(measures.values()), dtype=dtype)
+
+
+def get_array_measures(array):
+    return {name: float(array[name]) for name in array.dtype.names}
+
+
+def get_classes_fingerprints(dataset):
+    return [load_data.compute_file_fingerprint(dataset["path_lists_file"]),
+            load_data.compute_file_fingerprint(dataset["path_classes_file"])]
+
+
+def compute_cached_aggregation_cprr(parameters,
+                                    dataset,
+                                    fusion_backend,
+                                    tuples):
+    """
+    Same as fusion_backend.execute_aggregation_cprr, but only fuses the
+    tuples whose results are not in the cache. The descriptors are always
+    fused in sorted order (the ties of CPRR depend on the order of the
+    inputs), so the results do not depend on the order of the tuples.
+    """
+    sorted_tuples = [tuple(sorted(tup)) for tup in tuples]
+    if not is_cache_enabled(parameters):
+        computed = fusion_backend.execute_aggregation_cprr(parameters,
+                                                           dataset,
+                                                           sorted_tuples)
+        return {str(tup): computed[str(sorted_tup)]
+                for tup, sorted_tup in zip(tuples, sorted_tuples)}
+    descriptors = sorted(set([desc for tup in tuples for desc in tup]))
+    fingerprints = get_fingerprints(parameters, dataset, descriptors)
+    classes_fingerprints = get_classes_fingerprints(dataset)
+    keys = [get_cache_key("fusion",
+                          [fingerprints[desc] for desc in tup],
+                          classes_fingerprints,
+                          parameters["fusion_backend"],
+                          parameters["top_k"],
+                          dataset["rk_size"],
+                          evaluation_functions.get_evaluation_precisions(
+                              parameters, dataset["rk_size"]))
+            for tup in sorted_tuples]
+    cached = [load_cached_array(parameters, key) for key in keys]
+    missing = [i for i, value in enumerate(cached) if value is None]
+    print("\n Found cached fusion results for",
+          len(tuples)-len(missing), "of", len(tuples), "tuples")
+    if len(missing) > 0:
+        computed = fusion_backend.\
+            execute_aggregation_cprr(parameters,
+                                     dataset,
+                                     [sorted_tuples[i] for i in missing])
+        for i in missing:
+            cached[i] = get_measures_array(computed[str(sorted_tuples[i])])
+            store_cached_array(parameters, keys[i], cached[i])
+    evict_cache(parameters)
+    return dict(zip([str(tup) for tup in tuples],
+                    [get_array_measures(array) for array in cached]))
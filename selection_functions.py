@@ -21,30 +21,112 @@
 #
 
 
-def compute_selection_score(pair,
-                            effectiveness,
-                            correlations,
-                            beta=1):
-    eff1 = effectiveness[pair[0]]
-    eff2 = effectiveness[pair[1]]
-    cor = correlations[str(pair)]
+import numpy as np
+import correlation_functions
+
+
+def compute_selection_score(eff1, eff2, cor, beta=1):
     eff_score = (eff1*eff2)
     cor_score = (1 + cor)**beta
     return eff_score/cor_score
 
 
+def compute_tuple_selection_score(effectiveness, cor, beta=1):
+    """
+    Selection score of a tuple, using the geometric mean of the
+    effectiveness of its descriptors (the same as pairs for two)
+    """
+    eff = np.prod(effectiveness)**(1/len(effectiveness))
+    return compute_selection_score(eff, eff, cor, beta=beta)
+
+
 def compute_selection_for_pairs(parameters,
-                                pairs,
                                 effectiveness,
                                 correlations):
-    selection = {}
+    """
+    Returns the D x D matrix of selection scores, given the effectiveness
+    vector and the correlation matrix of the descriptors
+    """
     print("\n Computing selection scores...")
-    for pair in pairs:
-        # print("\tComputing sel. score for", pair)
-        selection[str(pair)] = compute_selection_score(
-                                            pair,
-                                            effectiveness,
-                                            correlations,
-                                            beta=parameters["beta"])
+    selection = compute_selection_score(effectiveness[:, None],
+                                        effectiveness[None, :],
+                                        correlations,
+                                        beta=parameters["beta"])
     print(" Done!")
     return selection
+
+
+def get_pairs_selection_scores(descriptors, selection):
+    """
+    Converts the selection matrix to a dictionary {str(pair): score}
+    """
+    rows, cols = np.triu_indices(len(descriptors), 1)
+    return {str((descriptors[i], descriptors[j])): float(selection[i, j])
+            for i, j in zip(rows, cols)}
+
+
+def compute_selection_upper_bounds(parameters, effectiveness, pairs_indexes):
+    """
+    Returns the maximum selection score that each pair can reach, given
+    only the effectiveness and the range of the correlation measure
+    """
+    beta = parameters["beta"]
+    (min_correlation,
+     max_correlation) = correlation_functions.\
+        get_correlation_range(parameters["correlation_measure"])
+    worst_correlation = min_correlation if beta >= 0 else max_correlation
+    rows, cols = pairs_indexes
+    if beta > 0 and 1 + worst_correlation <= 0:
+        return np.full(len(rows), np.inf)
+    return compute_selection_score(effectiveness[rows],
+                                   effectiveness[cols],
+                                   worst_correlation,
+                                   beta=beta)
+
+
+def compute_lazy_query_correlations(parameters,
+                                    descriptors,
+                                    effectiveness,
+                                    compute_batch_correlations):
+    """
+    Computes the correlations of the pairs in decreasing order of their
+    selection upper bounds, in batches, and stops when no remaining pair
+    can enter the top tuples. 'compute_batch_correlations' returns the
+    N x P query correlations of a list of pairs. Returns the indexes of
+    the computed pairs (in the order of
+    tuples_processing.compute_possible_pairs) and their N x P' query
+    correlations.
+    """
+    n_top = max(parameters["top_tuples_intersection"],
+                parameters["top_tuples_fusion"])
+    rows, cols = np.triu_indices(len(descriptors), 1)
+    upper_bounds = compute_selection_upper_bounds(parameters,
+                                                  effectiveness,
+                                                  (rows, cols))
+    order = np.argsort(-upper_bounds, kind='stable')
+    batch_size = max(n_top, parameters["multithreading_pools"])
+    computed = []
+    query_correlations = []
+    selection = np.array([])
+    for start in range(0, len(order), batch_size):
+        # Stop when the best remaining pair can not reach the top pairs
+        if (len(selection) >= n_top and upper_bounds[order[start]] <
+                np.partition(selection, len(selection)-n_top)[-n_top]):
+            break
+        batch = order[start:start+batch_size]
+        pairs = [(descriptors[rows[k]], descriptors[cols[k]]) for k in batch]
+        batch_correlations = compute_batch_correlations(pairs)
+        computed.extend(batch)
+        query_correlations.append(batch_correlations)
+        selection = np.append(selection, compute_selection_score(
+                                effectiveness[rows[batch]],
+                                effectiveness[cols[batch]],
+                                np.mean(batch_correlations, axis=0),
+                                beta=parameters["beta"]))
+    print("\n Computed correlations for", len(computed), "of", len(order),
+          "pairs")
+    # Restore the order of the pairs
+    computed = np.array(computed)
+    pairs_order = np.argsort(computed)
+    return (computed[pairs_order],
+            np.concatenate(query_correlations, axis=1)[:, pairs_order])
@@ -35,16 +35,30 @@ def show_settings(parameters, dataset):
     print("\tEffectiveness Estimation Measure:",
           parameters["effectiveness_estimation_measure"])
     print("\tCorrelation Measure:", parameters["correlation_measure"])
+    if parameters["selection_mode"] == "tuples_correlation":
+        print("\tTuple Correlation Measure:",
+              parameters["tuple_correlation_measure"])
+    print("\tRBO Persistence (p):", parameters["rbo_p"])
     print("\tBeta (cor. coef.):", parameters["beta"])
+    if parameters["estimate_expoents"]:
+        print("\tBeta Grid (start, stop, num):", parameters["beta_grid"])
     print("\tTop K:", parameters["top_k"])
+    print("\tTop K Sweep:", parameters["top_k_sweep"])
     print("\tEffectiveness Measure:", parameters["supervised_effectiveness"])
     print("\tTop Tuples to Fuse:", parameters["top_tuples_fusion"])
+    print("\tFusion Backend:", parameters["fusion_backend"])
     print("\tTop Tuples for Intersection:",
           parameters["top_tuples_intersection"])
+    print("\tTop Tuples for Exact Search:", parameters["top_tuples_exact"])
     print("\tMax Tuple Size:", parameters["max_tuple_size"])
     print("\tPerform Fusion:", parameters["perform_fusion"])
+    print("\tLazy Correlations:", parameters["lazy_correlations"])
+    print("\tSave Query Scores:", parameters["save_query_scores"])
     print("\tPerform Evaluation:", parameters["perform_evaluation"])
+    print("\tEvaluation Precisions (k):", parameters["evaluation_precisions"])
     print("\tMultithreading Pools:", parameters["multithreading_pools"])
+    print("\tCache Directory:", parameters["cache_dir"])
+    print("\tCache Max Size (MB):", parameters["cache_max_size_mb"])
     print(" Dataset info:")
     print("\tDataset name:", dataset["name"])
     print("\tDataset size:", dataset["size"])
@@ -83,6 +97,21 @@ def show_correlation_results(correlations):
     pprint(correlations, indent=8)
 
 
+def show_top_k_sweep_results(k_values, effectiveness, correlations):
+    def show_table(values):
+        labels = list(values[k_values[0]])
+        width = max([len(label) for label in labels] + [1])
+        print("\t" + "k".ljust(width), *[str(k).rjust(8) for k in k_values])
+        for label in labels:
+            print("\t" + label.ljust(width),
+                  *["%8.4f" % values[k][label] for k in k_values])
+
+    print("\n Effectiveness estimation for each k:")
+    show_table(effectiveness)
+    print("\n Correlation for each k:")
+    show_table(correlations)
+
+
 def show_pairs_selection_results(selection_pairs):
     print("\n Selection score for each pair:")
     pprint(selection_pairs, indent=8)
@@ -99,6 +128,27 @@ def show_pairs_map_results(parameters, pairs_map):
     pprint(pairs_map, indent=8)
 
 
+def show_supervised_measures(measures):
+    labels = list(measures)
+    columns = []
+    for label in labels:
+        columns += [name for name in measures[label]
+                    if name not in columns and name != "Before"]
+    # MAP, P@k, Recall@k and the other measures (e.g. Time), in this order
+    columns = sorted(columns,
+                     key=lambda name: (name != "MAP",
+                                       not name.startswith("P@"),
+                                       not name.startswith("Recall@")))
+    width = max([len(label) for label in labels] + [1])
+    print("\n Supervised effectiveness measures:")
+    print("\t" + "".ljust(width), *[column.rjust(10) for column in columns])
+    for label in labels:
+        values = [measures[label].get(column, float("nan"))
+                  for column in columns]
+        print("\t" + label.ljust(width),
+              *["%10.4f" % value for value in values])
+
+
 def show_descriptors_map_results(parameters, descriptors_map):
     print("\n", parameters["supervised_effectiveness"].upper(),
           "results for each descriptor:")
@@ -29,10 +29,13 @@ import correlation_functions
 import selection_functions
 import tuples_processing
 import rank_dictionaries
+import results_cache
 import evaluation_functions
 import octave_calls
 import execute_udlf
+import fusion_functions
 import numpy as np
+from functools import partial
 
 
 def perform_loading_stage(parameters, dataset):
@@ -47,6 +50,75 @@ def perform_loading_stage(parameters, dataset):
     return ranked_lists
 
 
+def perform_top_k_sweep_stage(parameters, dataset):
+    print("\n\n---------------------------------")
+    print(" TOP-K SWEEP STAGE")
+
+    k_values = sorted(set(parameters["top_k_sweep"]))
+    if k_values[0] < 1 or k_values[-1] > dataset["rk_size"]:
+        print("\n ERROR: Invalid top_k_sweep values:", k_values)
+        exit(1)
+
+    # Load the ranked lists with the largest neighborhood size
+    sweep_parameters = dict(parameters)
+    sweep_parameters["top_k"] = k_values[-1]
+    descriptors = load_data.list_descriptors(dataset["path_ranked_lists"])
+    ranked_lists = load_data.load_ranked_lists(sweep_parameters,
+                                               descriptors,
+                                               dataset["path_ranked_lists"])
+    pairs = tuples_processing.compute_possible_pairs(descriptors)
+
+    # Compute all the values of k in a single pass
+    effectiveness = effectiveness_estimation_functions.\
+        compute_descriptors_effectiveness_sweep(
+                        parameters,
+                        parameters["effectiveness_estimation_measure"],
+                        ranked_lists,
+                        descriptors,
+                        k_values)
+    correlations = correlation_functions.\
+        compute_correlations_sweep_for_pairs(
+                        parameters,
+                        parameters["correlation_measure"],
+                        ranked_lists,
+                        pairs,
+                        k_values)
+    show_messages.show_top_k_sweep_results(k_values,
+                                           effectiveness,
+                                           correlations)
+
+    return effectiveness, correlations
+
+
+def check_lazy_correlations(parameters):
+    """
+    The pruning of the pairs depends on beta and only keeps the pairs
+    that can reach the top tuples of the heuristic selection modes
+    """
+    if (parameters["selection_mode"] not in ["pairs_only",
+                                             "tuples_intersection"] or
+            parameters["estimate_expoents"] or
+            parameters["perform_evaluation"]):
+        print("\n ERROR: lazy_correlations requires the \"pairs_only\" or",
+              "\"tuples_intersection\" selection modes, without",
+              "estimate_expoents and perform_evaluation")
+        exit(1)
+
+
+def get_fusion_backend(parameters):
+    """
+    Returns the module that runs the CPRR fusion (both expose
+    execute_aggregation_cprr)
+    """
+    backend = parameters["fusion_backend"]
+    if backend == "udlf":
+        return execute_udlf
+    elif backend == "native":
+        return fusion_functions
+    print("\n ERROR: Unknown fusion backend:", backend)
+    exit(1)
+
+
 def perform_pre_selection_stage(parameters, dataset, ranked_lists):
     print("\n\n---------------------------------")
     print(" PRE-SELECTION STAGE")
@@ -65,27 +137,66 @@ def perform_pre_selection_stage(parameters, dataset, ranked_lists):
     # Compute effectiveness estimations and rank descriptors
     effectiveness_function = effectiveness_estimation_functions.\
         get_effectiveness_func(parameters["effectiveness_estimation_measure"])
-    effectiveness = effectiveness_estimation_functions.\
-        compute_descriptors_effectiveness(parameters,
-                                          effectiveness_function,
-                                          ranked_lists,
-                                          descriptors,
-                                          parameters["top_k"])
+    query_effectiveness = results_cache.\
+        compute_cached_query_effectiveness(parameters,
+                                           dataset,
+                                           effectiveness_function,
+                                           ranked_lists,
+                                           descriptors)
+    effectiveness = np.mean(query_effectiveness, axis=0)
     effectiveness_rk = rank_dictionaries.\
-        rank_descriptors_by_effec_estim(effectiveness)
+        rank_descriptors_by_effec_estim(descriptors, effectiveness)
     show_messages.show_effectiveness_results(effectiveness_rk)
 
     # Compute correlations for pairs and rank them
     correlation_function = correlation_functions.get_correlation_func(
-                           parameters["correlation_measure"])
+                           parameters["correlation_measure"],
+                           rbo_p=parameters["rbo_p"])
+    if parameters["lazy_correlations"]:
+        check_lazy_correlations(parameters)
+        # The same pool (and shared ranked lists) is used by all the batches
+        with load_data.shared_ranked_lists_pool(parameters,
+                                                ranked_lists,
+                                                sorted(ranked_lists)) as p:
+            compute_batch_correlations = partial(
+                results_cache.compute_cached_query_correlations,
+                parameters,
+                dataset,
+                correlation_function,
+                ranked_lists,
+                pool=p)
+            (computed,
+             query_correlations) = selection_functions.\
+                compute_lazy_query_correlations(parameters,
+                                                descriptors,
+                                                effectiveness,
+                                                compute_batch_correlations)
+        # The pairs that were not computed are kept as NaN
+        pair_correlations = np.full(len(pairs), np.nan)
+        pair_correlations[computed] = np.mean(query_correlations, axis=0)
+        pairs = [pairs[i] for i in computed]
+    else:
+        query_correlations = results_cache.\
+            compute_cached_query_correlations(parameters,
+                                              dataset,
+                                              correlation_function,
+                                              ranked_lists,
+                                              pairs)
+        pair_correlations = np.mean(query_correlations, axis=0)
     correlations = correlation_functions.\
-        compute_correlations_for_pairs(parameters,
-                                       correlation_function,
-                                       ranked_lists,
-                                       pairs,
-                                       parameters["top_k"])
+        get_correlation_matrix(len(descriptors), pair_correlations)
     correlation_rk = rank_dictionaries.rank_pairs_by_correlation(correlations)
-    show_messages.show_correlation_results(correlation_rk)
+    show_messages.show_correlation_results(
+        tuples_processing.get_named_tuples(descriptors, correlation_rk))
+
+    # Keep the per-query scores for further analysis
+    if parameters["save_query_scores"]:
+        load_data.save_query_scores(parameters,
+                                    dataset,
+                                    descriptors,
+                                    pairs,
+                                    query_effectiveness,
+                                    query_correlations)
 
     # Estimate values for beta
     if parameters["estimate_expoents"]:
@@ -94,26 +205,26 @@ def perform_pre_selection_stage(parameters, dataset, ranked_lists):
                                                    correlations)
         parameters["beta"] = beta
 
-    return pairs, effectiveness, correlations
+    return descriptors, effectiveness, correlations
 
 
 def perform_selection_stage(parameters,
                             dataset,
-                            pairs,
+                            ranked_lists,
+                            descriptors,
                             effectiveness,
                             correlations):
     print("\n\n---------------------------------")
     print(" SELECTION STAGE")
 
     # Compute selection measure for each pair and rank them
-    selected_pairs_scores = selection_functions.\
+    selection = selection_functions.\
         compute_selection_for_pairs(parameters,
-                                    pairs,
                                     effectiveness,
                                     correlations)
-    selected_pairs_rk = rank_dictionaries.\
-        rank_pairs_by_selection(selected_pairs_scores)
-    show_messages.show_pairs_selection_results(selected_pairs_rk)
+    selected_pairs_rk = rank_dictionaries.rank_pairs_by_selection(selection)
+    show_messages.show_pairs_selection_results(
+        tuples_processing.get_named_tuples(descriptors, selected_pairs_rk))
 
     # Select tuples according to the specified selection mode
     selection_mode = parameters["selection_mode"]
@@ -123,13 +234,28 @@ def perform_selection_stage(parameters,
     elif selection_mode == "tuples_intersection":
         selected_tuples_rk = tuples_processing.\
             compute_tuples_intersection(parameters, selected_pairs_rk)
+    elif selection_mode == "tuples_exact":
+        selected_tuples_rk = tuples_processing.\
+            compute_tuples_exact(parameters, selection)
+    elif selection_mode == "tuples_correlation":
+        selected_tuples_rk = tuples_processing.\
+            compute_tuples_correlation(parameters,
+                                       ranked_lists,
+                                       descriptors,
+                                       effectiveness,
+                                       selected_pairs_rk)
     else:
         print("\n ERROR: Unknown selection mode:", selection_mode)
         exit(1)
 
+    # Convert the tuples of descriptor indexes into tuples of names
+    selected_tuples_rk = {size: tuples_processing.
+                          get_named_tuples(descriptors,
+                                           selected_tuples_rk[size])
+                          for size in selected_tuples_rk}
     show_messages.show_tuples_selection_results(selected_tuples_rk)
 
-    return selected_pairs_scores, selected_tuples_rk
+    return selection, selected_tuples_rk
 
 
 def perform_fusion_stage(parameters, dataset, selected_tuples):
@@ -137,22 +263,28 @@ def perform_fusion_stage(parameters, dataset, selected_tuples):
     print(" FUSION STAGE")
 
     top_tuples_fusion = parameters["top_tuples_fusion"]
+    fusion_backend = get_fusion_backend(parameters)
 
     for tuple_size in selected_tuples:
         print("\n Executing tuples of", tuple_size, "elements...")
         combinations = [elem[0] for elem in selected_tuples[tuple_size]]
         combinations = combinations[:top_tuples_fusion]
-        results = execute_udlf.execute_aggregation_cprr(parameters,
-                                                        dataset,
-                                                        combinations)
+        results = results_cache.\
+            compute_cached_aggregation_cprr(parameters,
+                                            dataset,
+                                            fusion_backend,
+                                            combinations)
+        show_messages.show_supervised_measures(results)
         print("\n", parameters["supervised_effectiveness"].upper(),
               "of the selected tuples (", tuple_size,
               "elements ) fused with CPRR:")
 
         result_list = []
         for result in results:
-            result_list.append(results[result])
-            print("\t", result, " = ", "%0.4f" % float(results[result]))
+            value = evaluation_functions.\
+                get_supervised_effectiveness(parameters, results[result])
+            result_list.append(value)
+            print("\t", result, " = ", "%0.4f" % value)
         avg = np.average(result_list)
         avg_weighted = np.average(result_list,
                                   weights=range(len(result_list), 0, -1))
@@ -164,22 +296,41 @@ def perform_fusion_stage(parameters, dataset, selected_tuples):
               ":", "%0.4f" % avg_weighted)
 
 
-def perform_evaluation_stage(parameters, dataset, pairs, selection_scores):
+def perform_evaluation_stage(parameters, dataset, descriptors, selection):
     print("\n\n---------------------------------")
     print(" EVALUATION STAGE")
 
     print(" WARNING: This mode only evaluates pairs!")
 
-    # Compute supervised effectiveness measure for each descriptor
-    descriptors_map = execute_udlf.\
-        execute_eval_isolated_descriptors(parameters, dataset)
+    fusion_backend = get_fusion_backend(parameters)
+
+    pairs = tuples_processing.compute_possible_pairs(descriptors)
+    selection_scores = selection_functions.\
+        get_pairs_selection_scores(descriptors, selection)
+
+    # Compute supervised effectiveness measures for each descriptor
+    descriptors_measures = evaluation_functions.\
+        evaluate_isolated_descriptors(parameters, dataset)
+    show_messages.show_supervised_measures(descriptors_measures)
+    descriptors_map = {desc: evaluation_functions.
+                       get_supervised_effectiveness(parameters,
+                                                    descriptors_measures[desc])
+                       for desc in descriptors_measures}
     descriptors_map_rk = rank_dictionaries.\
         rank_descriptors_by_map(descriptors_map)
     show_messages.show_descriptors_map_results(parameters, descriptors_map_rk)
 
     # Run CPRR for each pair and rank them
-    pairs_map = execute_udlf.\
-        execute_aggregation_cprr(parameters, dataset, pairs)
+    pairs_measures = results_cache.\
+        compute_cached_aggregation_cprr(parameters,
+                                        dataset,
+                                        fusion_backend,
+                                        pairs)
+    show_messages.show_supervised_measures(pairs_measures)
+    pairs_map = {pair: evaluation_functions.
+                 get_supervised_effectiveness(parameters,
+                                              pairs_measures[pair])
+                 for pair in pairs_measures}
     pairs_map_rk = rank_dictionaries.rank_pairs_by_map(pairs_map)
     show_messages.show_pairs_map_results(parameters, pairs_map_rk)
 
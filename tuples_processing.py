@@ -21,7 +21,11 @@
 #
 
 
+import heapq
 import itertools
+import numpy as np
+import correlation_functions
+import selection_functions
 
 
 def compute_possible_pairs(descriptors):
@@ -37,12 +41,20 @@ def compute_possible_tuples(descriptors):
     return combinations
 
 
+def get_named_tuples(descriptors, tuples_rk):
+    """
+    Converts ranked tuples of descriptor indexes into tuples of names
+    """
+    return [[tuple([descriptors[i] for i in elem[0]]), elem[1]]
+            for elem in tuples_rk]
+
+
 def compute_tuples_pairs(parameters, selected_pairs_rk):
     # Number of pairs to consider
     top_tuples_fusion = parameters["top_tuples_fusion"]
 
-    # Get the first pairs converting the pair from string to tuple type
-    top_tuples = [[eval(elem[0]), elem[1]]
+    # Get the first pairs
+    top_tuples = [[elem[0], elem[1]]
                   for elem in selected_pairs_rk[:top_tuples_fusion]]
 
     # Add the best pairs to the selected tuples dictionary
@@ -51,12 +63,43 @@ def compute_tuples_pairs(parameters, selected_pairs_rk):
     return selected_tuples
 
 
+def get_bitset_tuple(bitset):
+    """
+    Converts the bitset of a tuple back into the sorted descriptor indexes
+    """
+    bits = np.unpackbits(bitset.astype('<u8').view(np.uint8),
+                         bitorder='little')
+    return tuple([int(i) for i in np.flatnonzero(bits)])
+
+
+def compute_tuples_unions(top_tuples, min_intersection):
+    """
+    Yields [bitset, score] for the union of each pair of tuples sharing at
+    least 'min_intersection' descriptors, in the order of the comparisons
+    and skipping repeated unions
+    """
+    tuples = np.array([elem[0] for elem in top_tuples])
+    scores = [elem[1] for elem in top_tuples]
+    bitsets = correlation_functions.compute_bitsets(tuples,
+                                                    int(tuples.max())+1)
+    # This set is used to prevent the insertion of repeated tuples
+    unions_set = set()
+    for i in range(len(top_tuples)-1):
+        intersections = correlation_functions.\
+            popcount(bitsets[i] & bitsets[i+1:])
+        for j in i + 1 + np.flatnonzero(intersections >= min_intersection):
+            union = bitsets[i] | bitsets[j]
+            if union.tobytes() not in unions_set:
+                unions_set.add(union.tobytes())
+                yield [union, scores[i] + scores[j]]
+
+
 def compute_tuples_intersection(parameters, selected_pairs_rk):
     # Number of pairs to consider for computing the intersection
     top_tuples_intersection = parameters["top_tuples_intersection"]
 
-    # Get the first pairs converting the pair from string to tuple type
-    top_tuples = [[eval(elem[0]), elem[1]]
+    # Get the first pairs
+    top_tuples = [[elem[0], elem[1]]
                   for elem in selected_pairs_rk[:top_tuples_intersection]]
 
     # Add the best pairs to the selected tuples dictionary
@@ -65,42 +108,204 @@ def compute_tuples_intersection(parameters, selected_pairs_rk):
     # Select tuples through intersection
     max_tuple_size = parameters["max_tuple_size"]
     for current_tuple_size in range(3, max_tuple_size+1):
-        # Init list to store the tuples of the current iteration
-        current_tuples = []
-        # This set is used to prevent the insertion of repeated tuples
-        tuples_set = set()
-        for i, elem1 in enumerate(top_tuples):
-            # Get elements of the first tuple
-            tuple1 = elem1[0]
-            tuple1_score = elem1[1]
-            for elem2 in top_tuples[i+1:]:
-                # Get elements of the second tuple
-                tuple2 = elem2[0]
-                tuple2_score = elem2[1]
-                # If there's intersection, compute a new tuple based on union
-                intersection = set(tuple1) & set(tuple2)
-                if len(intersection) >= current_tuple_size-2:
-                    new_tuple = tuple(sorted(set(tuple1) | set(tuple2)))
-                    # Check if the tuple is not repeated
-                    if new_tuple not in tuples_set:
-                        # Compute the selection score for the new tuple
-                        new_tuple_score = tuple1_score + tuple2_score
-                        # Add it to the tuple set (to prevent repetition)
-                        tuples_set.add(new_tuple)
-                        # Add it to the list of tuples of the current size
-                        current_tuples.append([new_tuple, new_tuple_score])
+        if len(top_tuples) < 2:
+            break
+        # Keep only the best tuples of the current size with a bounded heap
+        # (ties keep the order in which the tuples were found)
+        current_tuples = heapq.nlargest(
+                            top_tuples_intersection,
+                            compute_tuples_unions(top_tuples,
+                                                  current_tuple_size-2),
+                            key=lambda x: x[1])
         # If there are no new tuples, just stop
         if current_tuples == []:
             break
-        # Sort tuples by score
-        current_tuples = sorted(current_tuples,
-                                key=lambda x: x[1],
-                                reverse=True)
-        # Crop the list to consider only the best tuples
-        current_tuples = current_tuples[:top_tuples_intersection]
+        current_tuples = [[get_bitset_tuple(bitset), score]
+                          for bitset, score in current_tuples]
         # Update dictionary with the new tuples
         selected_tuples[current_tuple_size] = current_tuples
         # Set top tuples for the next iteration
         top_tuples = current_tuples
 
     return selected_tuples
+
+
+def push_best_tuple(best_tuples, max_tuples, new_tuple, score):
+    """
+    Keeps the 'max_tuples' best tuples in the min-heap 'best_tuples'.
+    Tuples are stored negated, so ties keep the ones found first
+    (lexicographically smaller).
+    """
+    elem = (score, tuple([-i for i in new_tuple]))
+    if len(best_tuples) < max_tuples:
+        heapq.heappush(best_tuples, elem)
+    elif score > best_tuples[0][0]:
+        heapq.heapreplace(best_tuples, elem)
+
+
+def get_heap_threshold(best_tuples, max_tuples):
+    if len(best_tuples) < max_tuples:
+        return -np.inf
+    return best_tuples[0][0]
+
+
+def search_best_tuples(scores,
+                       row_bounds,
+                       tuple_size,
+                       max_tuples,
+                       best_tuples,
+                       chosen,
+                       score,
+                       gains,
+                       candidates):
+    """
+    Depth-first branch-and-bound over the tuples extending 'chosen' with
+    the 'candidates'. 'gains' stores, for each descriptor, the sum of its
+    pair scores with the chosen descriptors.
+    """
+    remaining = tuple_size - len(chosen)
+    if len(candidates) < remaining:
+        return
+    # Each new descriptor adds its gain plus at most half of its best
+    # (remaining-1) pair scores among the other new descriptors
+    bounds = gains[candidates] + row_bounds[candidates, remaining-1]/2
+    if len(candidates) > remaining:
+        bounds = np.partition(bounds, len(candidates)-remaining)
+    bound = score + np.sum(bounds[-remaining:])
+    threshold = get_heap_threshold(best_tuples, max_tuples)
+    if bound + 1e-9*(abs(bound) + 1) <= threshold:
+        return
+    if remaining == 1:
+        totals = score + gains[candidates]
+        for j, total in zip(candidates, totals):
+            if total > get_heap_threshold(best_tuples, max_tuples):
+                push_best_tuple(best_tuples,
+                                max_tuples,
+                                tuple(chosen + [int(j)]),
+                                float(total))
+        return
+    for i, j in enumerate(candidates[:len(candidates)-remaining+1]):
+        search_best_tuples(scores,
+                           row_bounds,
+                           tuple_size,
+                           max_tuples,
+                           best_tuples,
+                           chosen + [int(j)],
+                           score + gains[j],
+                           gains + scores[j],
+                           candidates[i+1:])
+
+
+def compute_tuples_exact(parameters, selection):
+    """
+    Finds the exact top tuples of each size, where the score of a tuple is
+    the sum of the selection scores of all its pairs
+    """
+    max_tuples = parameters["top_tuples_exact"]
+    n = selection.shape[0]
+
+    # Visit the descriptors with the highest scores first, so that the
+    # heap threshold grows fast and more branches are pruned
+    order = np.argsort(-(np.sum(selection, axis=1) - np.diag(selection)),
+                       kind='stable')
+    scores = np.array(selection, dtype=float)[np.ix_(order, order)]
+    np.fill_diagonal(scores, -np.inf)
+    # row_bounds[j, m] is the sum of the m best pair scores of j
+    row_bounds = np.zeros((n, n))
+    row_bounds[:, 1:] = np.cumsum(-np.sort(-scores, axis=1)[:, :n-1], axis=1)
+    np.fill_diagonal(scores, 0)
+
+    selected_tuples = {}
+    for tuple_size in range(2, min(parameters["max_tuple_size"], n)+1):
+        best_tuples = []
+        search_best_tuples(scores,
+                           row_bounds,
+                           tuple_size,
+                           max_tuples,
+                           best_tuples,
+                           [],
+                           0.0,
+                           np.zeros(n),
+                           np.arange(n))
+        best_tuples = sorted(best_tuples,
+                             key=lambda x: (-x[0], [-i for i in x[1]]))
+        selected_tuples[tuple_size] = [[tuple(sorted([int(order[-i])
+                                                      for i in elem[1]])),
+                                        elem[0]]
+                                       for elem in best_tuples]
+
+    return selected_tuples
+
+
+def compute_tuples_correlation(parameters,
+                               ranked_lists,
+                               descriptors,
+                               effectiveness,
+                               selected_pairs_rk):
+    """
+    Extends each of the top tuples by one descriptor at a time and scores
+    the new tuples with the tuple-level correlation measure. The state of
+    each kept tuple is obtained by extending the state of the tuple it
+    came from, and is reused to score all its extensions.
+    """
+    top_tuples_intersection = parameters["top_tuples_intersection"]
+    beta = parameters["beta"]
+    context = correlation_functions.\
+        init_tuple_context(parameters["tuple_correlation_measure"],
+                           [ranked_lists[desc] for desc in descriptors],
+                           parameters["top_k"])
+
+    # Get the first pairs
+    top_tuples = [[elem[0], elem[1]]
+                  for elem in selected_pairs_rk[:top_tuples_intersection]]
+    states = {elem[0]: correlation_functions.
+              compute_tuple_state(context, elem[0]) for elem in top_tuples}
+
+    # Add the best pairs to the selected tuples dictionary
+    selected_tuples = {2: top_tuples}
+
+    max_tuple_size = parameters["max_tuple_size"]
+    for current_tuple_size in range(3, max_tuple_size+1):
+        print("\n Computing tuple correlations for",
+              current_tuple_size, "elements...")
+        current_tuples = []
+        # Tuple and descriptor each new tuple was extended from (this is
+        # also used to prevent the insertion of repeated tuples)
+        origins = {}
+        for elem in top_tuples:
+            state = states[elem[0]]
+            for index in range(len(descriptors)):
+                new_tuple = tuple(sorted(elem[0] + (index,)))
+                if index in elem[0] or new_tuple in origins:
+                    continue
+                origins[new_tuple] = (elem[0], index)
+                correlation = np.mean(correlation_functions.
+                                      compute_extended_correlation(context,
+                                                                   state,
+                                                                   index))
+                new_tuple_score = selection_functions.\
+                    compute_tuple_selection_score(effectiveness[
+                                                    list(new_tuple)],
+                                                  correlation,
+                                                  beta=beta)
+                current_tuples.append([new_tuple, float(new_tuple_score)])
+        print(" Done!")
+        # If there are no new tuples, just stop
+        if current_tuples == []:
+            break
+        # Keep only the best tuples (ties keep the order they were found)
+        current_tuples = heapq.nlargest(top_tuples_intersection,
+                                        current_tuples,
+                                        key=lambda x: x[1])
+        # Update dictionary with the new tuples
+        selected_tuples[current_tuple_size] = current_tuples
+        # Set top tuples (and their states) for the next iteration
+        if current_tuple_size < max_tuple_size:
+            states = {elem[0]: correlation_functions.
+                      extend_tuple_state(context,
+                                         states[origins[elem[0]][0]],
+                                         origins[elem[0]][1])
+                      for elem in current_tuples}
+        top_tuples = current_tuples
+
+    return selected_tuples
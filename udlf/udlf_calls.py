@@ -22,9 +22,10 @@
 
 
 import os
+import tempfile
 import subprocess
 
-cur_path = os.path.dirname(__file__)
+cur_path = os.path.dirname(os.path.abspath(__file__))
 udlf_path = os.path.join(cur_path, 'bin/')
 udlf_bin = 'udlf'
 
@@ -64,98 +65,75 @@ def gen_config(parameters='', out_file='config.ini'):
     f.close()
 
 
-def run_udlf(parameters='', effectiveness_measure="map", exec_num=0):
+def parse_udlf_output(output):
     """
-    Given the parameters, performs a UDLF execution.
-    WARNING: The function returns the MAP or Precision, so make sure
-    to set the effectiveness parameters accordingly.
+    Parses the evaluation results printed by UDLF into a dictionary
+    {measure: value}, e.g. "MAP", "P@10", "Recall@40" and "Time" (in
+    seconds, if EFFICIENCY_EVAL is enabled). When UDLF reports the
+    results before and after the method, the dictionary contains the
+    results after it, and the ones before it are in results["Before"].
 
     Keyword arguments:
-    parameters -- parameters dictionary
-    effectiveness_measure -- supervised effectiveness measure to use
-    exec_num -- used to generate the config.ini avoiding file concurrency
+    output -- standard output of the UDLF execution
     """
-    # Create config file with the specified parameters
-    config_file = "config" + str(exec_num) + ".ini"
-    gen_config(parameters=parameters,
-               out_file=os.path.join(udlf_path, config_file))
-
-    # The MAP value occurence changes when rank aggregation is being used
-    if parameters['UDL_TASK'] == 'FUSION':
-        map_occurrence = 3
-        precision_occurrence = 1
-    else:
-        map_occurrence = 5
-        precision_occurrence = 2
-
-    # Strings for the execution call
-    exec_call = (os.path.join(udlf_path, udlf_bin) + ' ' +
-                 os.path.join(udlf_path, config_file))
-    if effectiveness_measure == "precision":
-        # P@K
-        proc_string = (exec_call + ' | grep P@ | sed -n ' +
-                       str(precision_occurrence) + 'p')
-    else:
-        # MAP
-        proc_string = (exec_call + ' | grep MAP | sed -n ' +
-                       str(map_occurrence) + 'p')
-
-    # Run UDLF and get the MAP value from the output
-    effec_value = subprocess.check_output(proc_string, shell=True,
-                                          stderr=subprocess.DEVNULL)
-
-    # Process the output string to get only the value
-    effec_value = float(str(effec_value).split('\\t')[-1].rstrip("\\n'"))
-
-    return effec_value
-
-
-def eval_supervised_effectiveness(path_file,
-                                  lists_path,
-                                  classes_path,
-                                  dataset_size,
-                                  top_k=20,
-                                  l_size=0,
-                                  effectiveness_measure="map",
-                                  exec_num=0):
+    results = {}
+    section = None
+    for line in output.splitlines():
+        line = line.strip()
+        if line == '- EVALUATION RESULTS -':
+            section = results
+        elif section is None:
+            continue
+        elif line.startswith('Total Time of the Algorithm Execution:'):
+            results['Time'] = float(line.split(':')[1].split()[0])
+        elif line == 'Before:':
+            section = results['Before'] = {}
+        elif line == 'After:':
+            section = results
+        elif line == 'Relative Gains:':
+            section = {}
+        else:
+            fields = line.split()
+            if len(fields) == 2:
+                try:
+                    section[fields[0]] = float(fields[1])
+                except ValueError:
+                    pass
+    return results
+
+
+def run_udlf(parameters=''):
     """
-    This function returns the original MAP or Precision of the
-    given ranked list file
+    Given the parameters, performs a UDLF execution and returns all
+    the evaluation results reported by it (see parse_udlf_output).
+    Each execution uses its own temporary directory (removed at the end)
+    for the config file and the files written by UDLF, such as log.txt,
+    so any number of executions can run concurrently.
 
     Keyword arguments:
-    path_file -- path of the ranked list file
-    lists_path -- path of the lists file
-    classes_path -- path of the classes file
-    dataset_size -- value of the dataset size
-    l_size -- ranked lists size
-    effectiveness_measure -- supervised effectiveness measure to use
-    exec_num -- used to generate the config.ini avoiding file concurrency
+    parameters -- parameters dictionary
     """
-    path_file = os.path.abspath(path_file)
+    with tempfile.TemporaryDirectory(prefix='udlf_') as work_path:
+        # Create config file with the specified parameters
+        config_file = os.path.join(work_path, 'config.ini')
+        gen_config(parameters=parameters, out_file=config_file)
 
-    if l_size == 0:
-        l_size = dataset_size
+        # Run UDLF (without a shell) and parse its output once.
+        # UDLF writes log.txt in the working directory and prints the
+        # evaluation results from it, so it must not be shared.
+        output = subprocess.run([os.path.join(udlf_path, udlf_bin),
+                                 config_file],
+                                cwd=work_path,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                universal_newlines=True,
+                                check=True).stdout
+
+    return parse_udlf_output(output)
 
-    eval_par_dict = {'UDL_TASK': 'UDL',
-                     'UDL_METHOD': 'NONE',
-                     'SIZE_DATASET': dataset_size,
-                     'INPUT_FILE_FORMAT': 'RK',
-                     'INPUT_RK_FORMAT': 'NUM',
-                     'INPUT_FILE': path_file,
-                     'INPUT_FILE_LIST': lists_path,
-                     'INPUT_FILE_CLASSES': classes_path,
-                     'OUTPUT_FILE': 'FALSE',
-                     'EFFICIENCY_EVAL': 'FALSE',
-                     'EFFECTIVENESS_EVAL': 'TRUE',
-                     'EFFECTIVENESS_COMPUTE_MAP': 'TRUE',
-                     'EFFECTIVENESS_COMPUTE_PRECISIONS': 'TRUE',
-                     'EFFECTIVENESS_PRECISIONS_TO_COMPUTE': top_k,
-                     'EFFECTIVENESS_COMPUTE_RECALL': 'FALSE',
-                     'PARAM_NONE_L': l_size}
-
-    return run_udlf(parameters=eval_par_dict,
-                    effectiveness_measure=effectiveness_measure,
-                    exec_num=exec_num)
+
+def get_precisions_value(precisions):
+    return ', '.join([str(k) for k in precisions])
 
 
 def fuse_tuple_cprr(tuple_combination,
@@ -166,11 +144,12 @@ def fuse_tuple_cprr(tuple_combination,
                     top_k=20,
                     num_iterations=1,
                     l_size=0,
-                    effectiveness_measure="map",
-                    exec_num=0):
+                    precisions=None,
+                    recall_at=0):
     """
-    This function returns the MAP or Precision value of the CPRR fusion
-    result for a given tuple/combination of descriptors.
+    This function returns the effectiveness measures (MAP, Precisions,
+    Recall and the execution time) of the CPRR fusion result for a given
+    tuple/combination of descriptors.
 
     Keyword arguments:
     tuple_combination -- tuple of descriptors to be fused
@@ -181,12 +160,15 @@ def fuse_tuple_cprr(tuple_combination,
     top_k -- CPRR neighborhood size
     num_iterations -- number of CPRR iterations
     l_size -- ranked lists size
-    effectiveness_measure -- supervised effectiveness measure to use
-    exec_num -- used to generate the config.ini avoiding file concurrency
+    precisions -- values of k of the P@k to compute (default: [top_k])
+    recall_at -- value of k of the Recall@k (0 to disable)
     """
     if l_size == 0:
         l_size = dataset_size
 
+    if precisions is None:
+        precisions = [top_k]
+
     fuse_cprr_dict = {'UDL_TASK': 'FUSION',
                       'UDL_METHOD': 'CPRR',
                       'SIZE_DATASET': dataset_size,
@@ -195,11 +177,12 @@ def fuse_tuple_cprr(tuple_combination,
                       'INPUT_FILE_LIST': os.path.abspath(lists_path),
                       'INPUT_FILE_CLASSES': os.path.abspath(classes_path),
                       'OUTPUT_FILE': 'FALSE',
-                      'EFFICIENCY_EVAL': 'FALSE',
+                      'EFFICIENCY_EVAL': 'TRUE',
                       'EFFECTIVENESS_EVAL': 'TRUE',
                       'EFFECTIVENESS_COMPUTE_MAP': 'TRUE',
                       'EFFECTIVENESS_COMPUTE_PRECISIONS': 'TRUE',
-                      'EFFECTIVENESS_PRECISIONS_TO_COMPUTE': top_k,
+                      'EFFECTIVENESS_PRECISIONS_TO_COMPUTE':
+                          get_precisions_value(precisions),
                       'EFFECTIVENESS_COMPUTE_RECALL': 'FALSE',
                       'PARAM_NONE_L': l_size,
                       'PARAM_CPRR_L': l_size,
@@ -213,8 +196,8 @@ def fuse_tuple_cprr(tuple_combination,
         input_file = os.path.join(path_files, input_file + ".txt")
         fuse_cprr_dict['INPUT_FILES_FUSION_' + str(i+1)] = input_file
 
-    output_effec = run_udlf(parameters=fuse_cprr_dict,
-                            effectiveness_measure=effectiveness_measure,
-                            exec_num=exec_num)
+    if recall_at > 0:
+        fuse_cprr_dict['EFFECTIVENESS_COMPUTE_RECALL'] = 'TRUE'
+        fuse_cprr_dict['EFFECTIVENESS_RECALL_AT'] = recall_at
 
-    return output_effec
+    return run_udlf(parameters=fuse_cprr_dict)
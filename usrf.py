@@ -56,22 +56,27 @@ if __name__ == "__main__":
     show_messages.show_usraf_header()
     show_messages.show_settings(parameters, dataset)
 
+    # Top-k sweep stage (evaluate several neighborhood sizes at once)
+    if parameters["top_k_sweep"]:
+        stages.perform_top_k_sweep_stage(parameters, dataset)
+
     # Loading stage
     ranked_lists = stages.perform_loading_stage(parameters, dataset)
 
     # Pre-selection stage
     # (compute cor., eff., and estimate the parameters)
-    (pairs,
+    (descriptors,
      effectiveness,
      correlations) = stages.perform_pre_selection_stage(parameters,
                                                         dataset,
                                                         ranked_lists)
 
     # Selection stage
-    (selected_pairs_scores,
+    (selection,
      selected_tuples_rk) = stages.perform_selection_stage(parameters,
                                                           dataset,
-                                                          pairs,
+                                                          ranked_lists,
+                                                          descriptors,
                                                           effectiveness,
                                                           correlations)
 
@@ -85,5 +90,5 @@ if __name__ == "__main__":
     if parameters["perform_evaluation"]:
         stages.perform_evaluation_stage(parameters,
                                         dataset,
-                                        pairs,
-                                        selected_pairs_scores)
+                                        descriptors,
+                                        selection)